@@ -1,16 +1,69 @@
 from torch.utils.data import Dataset
+import argparse
 import numpy as np
 import pickle
 import os
+import struct
 from PIL import Image
 
 
-class ImageNet(Dataset):
-    def unpickle(self, filename):
-        with open(filename, 'rb') as fo:
-            dict = pickle.load(fo)
-        return dict
+def unpickle(filename):
+    with open(filename, 'rb') as fo:
+        dict = pickle.load(fo)
+    return dict
+
+
+def batch_files(root, train=True):
+    if train:
+        return [os.path.join(root, 'train_data_batch_{}'.format(i + 1)) for i in range(10)]
+    return [os.path.join(root, 'val_data')]
+
+
+def converted_files(root, train=True):
+    split = 'train' if train else 'val'
+    return os.path.join(root, '{}_data.npy'.format(split)), os.path.join(root, '{}_labels.npy'.format(split))
+
+
+# bytes reserved for the .npy header of the converted images, enough for any shape of 32 x 32 x 3 images
+_HEADER_SIZE = 256
+
+
+def _npy_header(dtype, shape):
+    # version 1.0 .npy header of a C-ordered array, padded to _HEADER_SIZE bytes
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': shape})
+    magic = np.lib.format.magic(1, 0)
+    padding = _HEADER_SIZE - len(magic) - 2 - len(header) - 1
+    return magic + struct.pack('<H', _HEADER_SIZE - len(magic) - 2) + (header + ' ' * padding + '\n').encode('latin1')
+
 
+def convert(root, train=True):
+    # Writes the pickled batches of a split into one contiguous uint8 N x 32 x 32 x 3 .npy file and an int64
+    # .npy file of 0-based labels (see converted_files). Every batch is unpickled once and its images are
+    # appended behind room for the header, which is written once the number of images is known, so at most one
+    # batch is in memory. The files are renamed into place once complete.
+    root = os.path.expanduser(root)
+    data_path, labels_path = converted_files(root, train)
+    labels = []
+    with open(data_path + '.tmp', 'wb') as f:
+        f.seek(_HEADER_SIZE)
+        for filename in batch_files(root, train):
+            d = unpickle(filename)
+            f.write(np.ascontiguousarray(d['data'].reshape(-1, 3, 32, 32).transpose((0, 2, 3, 1))).tobytes())
+            labels.append(np.asarray(d['labels'], dtype=np.int64) - 1)
+            del d
+        f.seek(0)
+        labels = np.concatenate(labels)
+        f.write(_npy_header(np.uint8, (len(labels), 32, 32, 3)))
+
+    np.save(labels_path + '.tmp.npy', labels)
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(labels_path + '.tmp.npy', labels_path)
+    return data_path, labels_path
+
+
+class ImageNet(Dataset):
+    # Downsampled ImageNet 32x32 from its pickled batches. The batches are converted once (see convert) into
+    # contiguous .npy files next to them, which are memory-mapped so that DataLoader workers share the pages.
     def __init__(self, root, train=True, transform=None, target_transform=None):
         super().__init__()
         self.root = os.path.expanduser(root)
@@ -18,25 +71,11 @@ class ImageNet(Dataset):
         self.target_transform = target_transform
         self.train = train  # training set or test set
 
-        if self.train:
-            self.data = []
-            self.labels = []
-            for i in range(10):
-                filename = os.path.join(self.root, 'train_data_batch_{}'.format(i + 1))
-                d = self.unpickle(filename)
-                self.data.append(d['data'])
-                self.labels.extend(d['labels'])
-            self.data = np.concatenate(self.data, axis=0)
-        else:
-            filename = os.path.join(self.root, 'val_data')
-            d = self.unpickle(filename)
-            self.data = d['data']
-            self.labels = d['labels']
-
-        self.data = self.data.reshape(-1, 3, 32, 32)
-        self.data = self.data.transpose((0, 2, 3, 1))
-        self.labels = np.stack(self.labels, axis=0)
-        self.labels -= 1
+        data_path, labels_path = converted_files(self.root, train)
+        if not (os.path.exists(data_path) and os.path.exists(labels_path)):
+            convert(self.root, train)
+        self.data = np.load(data_path, mmap_mode='r')
+        self.labels = np.load(labels_path, mmap_mode='r')
 
     def __getitem__(self, index):
         """
@@ -46,11 +85,11 @@ class ImageNet(Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        img, target = self.data[index], self.labels[index]
+        img, target = self.data[index], int(self.labels[index])
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(img)
+        img = Image.fromarray(np.asarray(img))
 
         if self.transform is not None:
             img = self.transform(img)
@@ -73,10 +112,11 @@ class OordImageNet(Dataset):
         self.target_transform = target_transform
         self.train = train  # training set or test set
 
+        # memory-mapped, only the requested images are read and DataLoader workers share the pages
         if self.train:
-            self.data = np.load(os.path.join(root, 'train_32x32.npy'))
+            self.data = np.load(os.path.join(self.root, 'train_32x32.npy'), mmap_mode='r')
         else:
-            self.data = np.load(os.path.join(root, 'valid_32x32.npy'))
+            self.data = np.load(os.path.join(self.root, 'valid_32x32.npy'), mmap_mode='r')
 
         self.labels = np.zeros((self.data.shape[0])) / 0.
 
@@ -92,7 +132,7 @@ class OordImageNet(Dataset):
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(img)
+        img = Image.fromarray(np.asarray(img))
 
         if self.transform is not None:
             img = self.transform(img)
@@ -101,3 +141,13 @@ class OordImageNet(Dataset):
 
     def __len__(self):
         return len(self.data)
+
+
+if __name__ == '__main__':
+    # one-time conversion of the pickled batches, e.g. python -m datasets.imagenet --root run/datasets/imagenet
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, required=True, help='Directory of the pickled ImageNet 32x32 batches')
+    args = parser.parse_args()
+    for train in (True, False):
+        for path in convert(args.root, train):
+            print('Wrote {}'.format(path))
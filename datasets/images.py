@@ -0,0 +1,64 @@
+from torch.utils.data import Dataset
+import numpy as np
+import os
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff', '.webp')
+
+
+class NpyImages(Dataset):
+    # Images of a uint8 N x H x W x C (or N x H x W) .npy file, memory-mapped so that only the requested
+    # images are read. The target is the index of the image.
+    def __init__(self, path, transform=None):
+        super().__init__()
+        self.path = os.path.expanduser(path)
+        self.transform = transform
+        self.data = np.load(self.path, mmap_mode='r')
+
+    def __getitem__(self, index):
+        img = self.data[index]
+        if img.ndim == 3 and img.shape[-1] == 1:
+            img = img[..., 0]
+
+        # doing this so that it is consistent with all other datasets
+        # to return a PIL Image
+        img = Image.fromarray(np.asarray(img))
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, index
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ImageFiles(Dataset):
+    # Every image file below root, in sorted path order. The target is the index of the image.
+    def __init__(self, root, mode='RGB', transform=None):
+        super().__init__()
+        self.root = os.path.expanduser(root)
+        self.mode = mode
+        self.transform = transform
+        self.files = sorted(os.path.join(directory, filename)
+                            for directory, _, filenames in os.walk(self.root) for filename in filenames
+                            if filename.lower().endswith(IMAGE_EXTENSIONS))
+
+    def __getitem__(self, index):
+        with open(self.files[index], 'rb') as f:
+            img = Image.open(f).convert(self.mode)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, index
+
+    def __len__(self):
+        return len(self.files)
+
+
+def image_dataset(path, channels, transform=None):
+    # NpyImages for a .npy file, ImageFiles for a directory
+    if os.path.isdir(path):
+        return ImageFiles(path, mode='L' if channels == 1 else 'RGB', transform=transform)
+    return NpyImages(path, transform=transform)
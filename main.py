@@ -21,6 +21,13 @@ def parse_args_and_config():
     parser.add_argument('--verbose', type=str, default='info', help='Verbose level: info | debug | warning | critical')
     parser.add_argument('--test', action='store_true', help='Whether to test the model')
     parser.add_argument('--resume_training', action='store_true', help='Whether to resume training')
+    parser.add_argument('--task', type=str, default=None,
+                        help='Runner method to execute instead of train/test, e.g. benchmark')
+    parser.add_argument('--input', type=str, default=None,
+                        help='Input of the score task: a uint8 N x H x W x C .npy file or a directory of images')
+    parser.add_argument('--output', type=str, default=None, help='Output file of the score task')
+    parser.add_argument('--checkpoint', type=str, default='checkpoint.pth',
+                        help='Checkpoint to evaluate, a file in the log directory of the run or a path')
     args = parser.parse_args()
     run_id = str(os.getpid())
     run_time = time.strftime('%Y-%b-%d-%H-%M-%S')
@@ -32,7 +39,7 @@ def parse_args_and_config():
         config = yaml.load(f)
     new_config = dict2namespace(config)
 
-    if not args.test:
+    if not args.test and args.task is None:
         if not args.resume_training:
             if os.path.exists(args.log):
                 shutil.rmtree(args.log)
@@ -106,7 +113,9 @@ def main():
 
     try:
         runner = eval(args.runner)(args, config)
-        if not args.test:
+        if args.task is not None:
+            getattr(runner, args.task)()
+        elif not args.test:
             runner.train()
 
         else:
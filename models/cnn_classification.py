@@ -3,7 +3,6 @@ import torch.utils.data
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
-import numpy as np
 import math
 from .utils import *
 import tqdm
@@ -67,39 +66,23 @@ class BasicBlock(nn.Module):
         # Define masks
         # Mask out the element above diagonal
         self.type = type
-        self.mask1 = np.ones(self.weight1.shape, dtype=np.float32)
-        self.center_mask1 = np.zeros(self.weight1.shape, dtype=np.float32)
-        self.mask2 = np.ones(self.weight2.shape, dtype=np.float32)
-        self.center_mask2 = np.zeros(self.weight2.shape, dtype=np.float32)
-        self.mask3 = np.ones(self.weight3.shape, dtype=np.float32)
-        self.center_mask3 = np.zeros(self.weight3.shape, dtype=np.float32)
-
-        generate_masks(self.mask1, self.center_mask1, self.mask2, self.center_mask2, self.mask3, self.center_mask3,
-                       input_dim, latent_dim, type, config.model.rgb_last)
-
-        self.mask1 = nn.Parameter(torch.from_numpy(self.mask1), requires_grad=False)
-        self.center_mask1 = nn.Parameter(torch.from_numpy(self.center_mask1), requires_grad=False)
-        self.mask2 = nn.Parameter(torch.from_numpy(self.mask2), requires_grad=False)
-        self.center_mask2 = nn.Parameter(torch.from_numpy(self.center_mask2), requires_grad=False)
-        self.mask3 = nn.Parameter(torch.from_numpy(self.mask3), requires_grad=False)
-        self.center_mask3 = nn.Parameter(torch.from_numpy(self.center_mask3), requires_grad=False)
+        # shared by all blocks with the same mask_key and not saved in the state dict
+        self.mask_key = (input_dim, latent_dim, type, config.model.rgb_last, kernel1, kernel2, kernel3)
+        masks = get_mask_tensors(*self.mask_key, cache_dir=config.model.mask_cache_dir)
+        for name, mask in zip(MASK_NAMES, masks):
+            self.register_buffer(name, mask, persistent=False)
 
         self.non_linearity = F.leaky_relu
 
         self.t = nn.Parameter(torch.ones(1, *shape))
         self.shape = shape
         self.config = config
+        self._weight_cache = None
 
-
-   
-    def forward(self, x):
+    def _masked_weights(self):
         masked_weight1 = self.weight1 * self.mask1
         masked_weight3 = self.weight3 * self.mask3
 
-        # shape: B x latent_output . input_dim x img_size x img_size
-        latent_output = F.conv2d(x, masked_weight1, bias=self.bias1, padding=self.padding1, stride=1)
-        latent_output = self.non_linearity(latent_output)
-
         center1 = masked_weight1 * self.center_mask1  # shape: latent_dim.input_dim x input_dim x kernel x kernel
         center3 = masked_weight3 * self.center_mask3  # shape: input_dim x latent_dim.input_dim x kernel x kernel
 
@@ -116,60 +99,63 @@ class BasicBlock(nn.Module):
                                center2.shape[-2], center2.shape[-1])
 
         center2 = center2.permute(0, 2, 1, 3, 4, 5)
-        center2 = sign_prods * torch.abs(center2)
+        # only the centers matter, the kernel of center2 can be smaller than the ones of center1 and center3
+        center2 = sign_prods[..., self.kernel3 // 2, self.kernel1 // 2].unsqueeze(-1).unsqueeze(-1) * torch.abs(center2)
         center2 = center2.permute(0, 2, 1, 3, 4, 5).contiguous().view_as(self.weight2)
         masked_weight2 = (center2 * self.center_mask2 + self.weight2 * (1. - self.center_mask2)) * self.mask2
 
+        t = torch.max(torch.abs(self.t), torch.tensor(1e-12, device=self.t.device))
+        return masked_weight1, masked_weight2, masked_weight3, t
+
+    def masked_weights(self):
+        return cached_weights(self, (self.weight1, self.weight2, self.weight3, self.t), self._masked_weights)
+
+    def _apply(self, fn, *args, **kwargs):
+        self._weight_cache = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the masks were buffers still contain them
+        for name in MASK_NAMES:
+            state_dict.pop(prefix + name, None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x):
+        masked_weight1, masked_weight2, masked_weight3, t = self.masked_weights()
+
+        # shape: B x latent_output . input_dim x img_size x img_size
+        latent_output = F.conv2d(x, masked_weight1, bias=self.bias1, padding=self.padding1, stride=1)
+        latent_output = self.non_linearity(latent_output)
+
         latent_output = F.conv2d(latent_output, masked_weight2, bias=self.bias2, padding=self.padding2, stride=1)
         latent_output = self.non_linearity(latent_output)
 
         latent_output = F.conv2d(latent_output, masked_weight3, bias=self.bias3, padding=self.padding3, stride=1)
 
-        t = torch.max(torch.abs(self.t), torch.tensor(1e-12, device=x.device))
-
         output = latent_output + t * x
         return output
 
 
 class SpaceToDepth(nn.Module):
-    def __init__(self, block_size):
+    def __init__(self, block_size, channels_last=False):
         super(SpaceToDepth, self).__init__()
         self.block_size = block_size
         self.block_size_sq = block_size * block_size
+        self.channels_last = channels_last
 
     def forward(self, x):
-        output = x.permute(0, 2, 3, 1)
-        (batch_size, s_height, s_width, s_depth) = output.size()
-        d_depth = s_depth * self.block_size_sq
-        d_width = int(s_width / self.block_size)
-        d_height = int(s_height / self.block_size)
-        t_1 = output.split(self.block_size, 2)
-        stack = [t_t.reshape(batch_size, d_height, d_depth) for t_t in t_1]
-        output = torch.stack(stack, 1)
-        output = output.permute(0, 2, 1, 3)
-        output = output.permute(0, 3, 1, 2)
-        return output
+        return space_to_depth(x, self.block_size, self.channels_last)
 
 
 class DepthToSpace(nn.Module):
-    def __init__(self, block_size):
+    def __init__(self, block_size, channels_last=False):
         super(DepthToSpace, self).__init__()
         self.block_size = block_size
         self.block_size_sq = block_size * block_size
+        self.channels_last = channels_last
 
     def forward(self, x):
-        output = x.permute(0, 2, 3, 1)
-        (batch_size, d_height, d_width, d_depth) = output.size()
-        s_depth = int(d_depth / self.block_size_sq)
-        s_width = int(d_width * self.block_size)
-        s_height = int(d_height * self.block_size)
-        t_1 = output.reshape(batch_size, d_height, d_width, self.block_size_sq, s_depth)
-        spl = t_1.split(self.block_size, 3)
-        stack = [t_t.reshape(batch_size, d_height, s_width, s_depth) for t_t in spl]
-        output = torch.stack(stack, 0).transpose(0, 1).permute(0, 2, 1, 3, 4).reshape(batch_size, s_height, s_width,
-                                                                                      s_depth)
-        output = output.permute(0, 3, 1, 2)
-        return output
+        return depth_to_space(x, self.block_size, self.channels_last)
 
 
 class Net(nn.Module):
@@ -193,7 +179,7 @@ class Net(nn.Module):
 
         for layer_num in range(self.n_layers):
             if layer_num in subsampling_anchors:
-                self.layers.append(SpaceToDepth(2))
+                self.layers.append(SpaceToDepth(2, config.model.channels_last))
                 channel *= 2 * 2
                 image_size = int(image_size / 2)
                 # Note: do not do latent_size //= 2 * 2 for classification
@@ -211,6 +197,14 @@ class Net(nn.Module):
         self.pre_fc = nn.ELU()
         self.fc = nn.Linear(shape[0], config.data.num_classes)
 
+        if config.model.channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        share_masks(self)
+        return self
+
     def _make_layer(self, shape, block_num, latent_dim, input_dim, init_zero, batch_norm=False):
         layers = []
         for i in range(0, block_num):
@@ -233,6 +227,9 @@ class Net(nn.Module):
             padding = torch.zeros(x.shape[0], 16 - x.shape[1], x.shape[-2], x.shape[-1], device=x.device)
             x = torch.cat([x, padding], dim=1)
 
+        if self.config.model.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+
         for layer_num, layer in enumerate(self.layers):
             x = layer(x)
 
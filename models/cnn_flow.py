@@ -1,23 +1,45 @@
 import torch
 import torch.utils.data
 import torch.nn as nn
-import torch.nn.functional as F
 import torch.nn.init as init
-import numpy as np
 import math
 from .utils import *
+from .inversion import get_solver
+from .masked_conv import BandedMaskedConv
 import threading
 from torch.nn.parallel.parallel_apply import get_a_var, _get_device_index
 from itertools import product
+from functools import partial
 from tqdm import tqdm
-from numba import jit
 
 
-def elu_derivative(x, slope=1.0):
-    slope1 = torch.ones_like(x)
-    x = torch.min(x, torch.ones_like(x) * 70.)
-    slope2 = torch.exp(x) * slope
-    return torch.where(x > 0, slope1, slope2)
+def elu(x):
+    # Same arithmetic as EluWithDerivative, so value-only passes match the full forward bit for bit
+    return torch.where(x > 0, x, torch.clamp(x, max=0.).expm1_())
+
+
+class EluWithDerivative(torch.autograd.Function):
+    # ELU and its derivative from a single expm1: for x <= 0 the derivative exp(x) is elu(x) + 1, for x > 0
+    # it is 1 = expm1(0) + 1. Only the derivative is kept for the backward pass.
+    @staticmethod
+    def forward(ctx, x):
+        negative = torch.clamp(x, max=0.).expm1_()
+        derivative = negative + 1.
+        output = torch.where(x > 0, x, negative)
+        ctx.save_for_backward(derivative)
+        return output, derivative
+
+    @staticmethod
+    def backward(ctx, grad_output, grad_derivative):
+        derivative, = ctx.saved_tensors
+        # d elu / dx is the derivative itself, d derivative / dx is exp(x) for x < 0 (derivative < 1) and 0 otherwise
+        grad = grad_derivative * derivative
+        grad.masked_fill_(derivative >= 1., 0.)
+        return grad.add_(grad_output * derivative)
+
+
+def elu_with_derivative(x):
+    return EluWithDerivative.apply(x)
 
 
 def parallel_apply_sampling(modules, inputs, kwargs_tup=None, devices=None):
@@ -101,12 +123,143 @@ class DataParallelWithSampling(nn.DataParallel):
 
 
 class SequentialWithSampling(nn.Sequential):
-    def sampling(self, z):
+    def sampling(self, z, return_stats=False):
+        stats = []
         for module in reversed(self._modules.values()):
-            z = module.sampling(z)
+            if return_stats:
+                z, module_stats = module.sampling(z, return_stats=True)
+                stats.append(module_stats)
+            else:
+                z = module.sampling(z)
+
+        if return_stats:
+            # shape: B x n_blocks, columns in inversion order
+            return z, {key: torch.stack([s[key] for s in stats], dim=1) for key in stats[0]}
         return z
 
 
+class LogDetDiagonal(torch.autograd.Function):
+    # Diagonal of a block's Jacobian without materialising the B x latent x latent x input_dim x H x W
+    # broadcast of the plain formula:
+    #   diag[b, c] = sum_k derivative3[b, k, c] * sum_j weight[k, j, c] * derivative1[b, j, c]
+    # where weight already folds in the diagonals of all three masked weights. The contraction over j is done
+    # chunk_size samples at a time, in the forward as well as in the backward pass.
+    # With channels_last the derivatives are channels last tensors and everything is computed on their
+    # B x H x W x latent_dim x input_dim views, so that no NCHW copy is made and diag comes out channels last.
+    @staticmethod
+    def forward(ctx, derivative1, derivative3, weight, chunk_size, channels_last=False):
+        # derivative1, derivative3: B x latent_dim x input_dim x img_shape x img_shape
+        # weight: latent_dim x latent_dim x input_dim
+        if channels_last:
+            derivative1, derivative3 = derivative1.permute(0, 3, 4, 1, 2), derivative3.permute(0, 3, 4, 1, 2)
+            layout, latent_dim = 'bhw{}c', 3
+        else:
+            layout, latent_dim = 'b{}chw', 1
+        chunk_size = chunk_size or derivative1.shape[0]
+        diag = derivative1.new_empty(derivative1.shape[:latent_dim] + derivative1.shape[latent_dim + 1:])
+        for start in range(0, derivative1.shape[0], chunk_size):
+            end = start + chunk_size
+            latent = torch.einsum('kjc,{}->{}'.format(layout.format('j'), layout.format('k')),
+                                  weight, derivative1[start:end])
+            diag[start:end] = torch.sum(latent.mul_(derivative3[start:end]), dim=latent_dim)
+
+        ctx.chunk_size = chunk_size
+        ctx.channels_last = channels_last
+        ctx.save_for_backward(derivative1, derivative3, weight)
+        return diag.permute(0, 3, 1, 2) if channels_last else diag
+
+    @staticmethod
+    def backward(ctx, grad_diag):
+        derivative1, derivative3, weight = ctx.saved_tensors
+        if ctx.channels_last:
+            grad_diag = grad_diag.permute(0, 2, 3, 1)
+            layout, latent_dim = 'bhw{}c', 3
+        else:
+            layout, latent_dim = 'b{}chw', 1
+        k, j = layout.format('k'), layout.format('j')
+        grad_derivative1 = torch.empty_like(derivative1) if ctx.needs_input_grad[0] else None
+        grad_derivative3 = torch.empty_like(derivative3) if ctx.needs_input_grad[1] else None
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[2] else None
+
+        for start in range(0, derivative1.shape[0], ctx.chunk_size):
+            end = start + ctx.chunk_size
+            grad = grad_diag[start:end].unsqueeze(latent_dim)
+            if grad_derivative3 is not None:
+                latent = torch.einsum('kjc,{}->{}'.format(j, k), weight, derivative1[start:end])
+                grad_derivative3[start:end] = latent.mul_(grad)
+            if grad_derivative1 is not None or grad_weight is not None:
+                grad_latent = derivative3[start:end] * grad
+                if grad_derivative1 is not None:
+                    grad_derivative1[start:end] = torch.einsum('kjc,{}->{}'.format(k, j), weight, grad_latent)
+                if grad_weight is not None:
+                    grad_weight += torch.einsum('{},{}->kjc'.format(k, j), grad_latent, derivative1[start:end])
+
+        if ctx.channels_last:
+            # back to B x latent_dim x input_dim x img_shape x img_shape, the permutation is its own inverse
+            grad_derivative1 = None if grad_derivative1 is None else grad_derivative1.permute(0, 3, 4, 1, 2)
+            grad_derivative3 = None if grad_derivative3 is None else grad_derivative3.permute(0, 3, 4, 1, 2)
+        return grad_derivative1, grad_derivative3, grad_weight, None, None
+
+
+def trainable_weights(module):
+    # Weights of `module` that need gradients. In a DataParallel replica the parameters are plain tensors
+    # broadcast from the real ones (replica._parameters is empty) and are listed in _former_parameters instead,
+    # gradients w.r.t. them reach the real parameters through the broadcast.
+    if not getattr(module, '_is_replica', False):
+        return [p for p in module.parameters() if p.requires_grad]
+    weights = []
+    for submodule in module.modules():
+        if not hasattr(submodule, '_former_parameters'):
+            raise RuntimeError('training.reversible needs torch.nn.DataParallel replicas that expose '
+                               '_former_parameters, this version of PyTorch does not')
+        weights.extend(w for w in submodule._former_parameters.values() if w is not None and w.requires_grad)
+    return weights
+
+
+class ReversibleFlowFunction(torch.autograd.Function):
+    # Runs `layers` without keeping any activation alive. The backward pass rebuilds the input of every layer
+    # from its output with layer.sampling, re-runs that layer with autograd and backpropagates through it, so
+    # only one layer's activations exist at a time. The inverse is iterative, hence the gradients are as
+    # accurate as the inversion (model.n_iters, analysis.residual_tol).
+    @staticmethod
+    def forward(ctx, x, layers, *params):
+        log_det = torch.zeros(x.shape[0], device=x.device)
+        for layer in layers:
+            x, log_det = layer([x, log_det])
+
+        ctx.layers = layers
+        ctx.params = params
+        ctx.save_for_backward(x)
+        return x, log_det
+
+    @staticmethod
+    def backward(ctx, grad_output, grad_log_det):
+        output, = ctx.saved_tensors
+        if grad_log_det is None:
+            grad_log_det = torch.zeros(output.shape[0], device=output.device)
+        param_grads = {}
+
+        for layer in reversed(ctx.layers):
+            with torch.no_grad():
+                x = layer.sampling(output)
+
+            with torch.enable_grad():
+                x = x.detach().requires_grad_()
+                layer_params = trainable_weights(layer)
+                output, log_det = layer([x, torch.zeros(x.shape[0], device=x.device)])
+                outputs, grad_outputs = zip(*[(o, g) for o, g in zip((output, log_det), (grad_output, grad_log_det))
+                                              if o.requires_grad])
+                grads = torch.autograd.grad(outputs, [x] + layer_params, grad_outputs, allow_unused=True)
+
+            grad_output = grads[0]
+            for p, g in zip(layer_params, grads[1:]):
+                if g is not None:
+                    param_grads[id(p)] = g if id(p) not in param_grads else param_grads[id(p)] + g
+            output = x.detach()
+
+        return (grad_output, None) + tuple(param_grads.get(id(p)) for p in ctx.params)
+
+
 class BasicBlock(nn.Module):
     # Input_dim should be 1(grey scale image) or 3(RGB image), or other dimension if use SpaceToDepth
     def init_conv_weight(self, weight):
@@ -164,50 +317,33 @@ class BasicBlock(nn.Module):
         # Define masks
         # Mask out the element above diagonal
         self.type = type
-        self.mask1 = np.ones(self.weight1.shape, dtype=np.float32)
-        self.center_mask1 = np.zeros(self.weight1.shape, dtype=np.float32)
-        self.mask2 = np.ones(self.weight2.shape, dtype=np.float32)
-        self.center_mask2 = np.zeros(self.weight2.shape, dtype=np.float32)
-        self.mask3 = np.ones(self.weight3.shape, dtype=np.float32)
-        self.center_mask3 = np.zeros(self.weight3.shape, dtype=np.float32)
-
-        generate_masks(self.mask1, self.center_mask1, self.mask2, self.center_mask2, self.mask3, self.center_mask3,
-                       input_dim, latent_dim, type, config.model.rgb_last)
-
-        self.mask1 = nn.Parameter(torch.from_numpy(self.mask1), requires_grad=False)
-        self.center_mask1 = nn.Parameter(torch.from_numpy(self.center_mask1), requires_grad=False)
-        self.mask2 = nn.Parameter(torch.from_numpy(self.mask2), requires_grad=False)
-        self.center_mask2 = nn.Parameter(torch.from_numpy(self.center_mask2), requires_grad=False)
-        self.mask3 = nn.Parameter(torch.from_numpy(self.mask3), requires_grad=False)
-        self.center_mask3 = nn.Parameter(torch.from_numpy(self.center_mask3), requires_grad=False)
-
-        self.non_linearity = F.elu
-        self.non_linearity_derivative = elu_derivative
+        # shared by all blocks with the same mask_key and not saved in the state dict
+        self.mask_key = (input_dim, latent_dim, type, config.model.rgb_last, kernel1, kernel2, kernel3)
+        masks = get_mask_tensors(*self.mask_key, cache_dir=config.model.mask_cache_dir)
+        for name, mask in zip(MASK_NAMES, masks):
+            self.register_buffer(name, mask, persistent=False)
+
+        n_bands = config.model.conv_bands if config.model.rgb_last else 1
+        self.conv = BandedMaskedConv(input_dim, latent_dim, type, n_bands)
+
+        self.non_linearity = elu
+        self.non_linearity_with_derivative = elu_with_derivative
 
         self.t = nn.Parameter(torch.ones(1, *shape))
+        # inversion iterations of this block, set by the calibrate task, 0 uses model.n_iters
+        self.register_buffer('n_iters_budget', torch.zeros((), dtype=torch.long))
+        # max relative distance ||f(x) - t * x|| / ||t * x|| measured by the skip_analysis task, see scale_only
+        self.register_buffer('deviation', torch.full((), float('inf')))
+        # the deviation as a python float, so that scale_only does not synchronize with the device
+        self._deviation = float('inf')
         self.shape = shape
         self.config = config
+        self._weight_cache = None
 
-    def forward(self, x):
-        log_det = x[1]
-        x = x[0]
+    def _masked_weights(self, with_log_det=True):
         masked_weight1 = self.weight1 * self.mask1
         masked_weight3 = self.weight3 * self.mask3
 
-        # shape: B x latent_output . input_dim x img_size x img_size
-        latent_output = F.conv2d(x, masked_weight1, bias=self.bias1, padding=self.padding1, stride=1)
-
-        kernel_mid_y, kernel_mid_x = masked_weight1.shape[-2] // 2, masked_weight1.shape[-1] // 2
-        diag1 = torch.diagonal(
-            masked_weight1[..., kernel_mid_y, kernel_mid_x].view(self.latent_dim, self.input_dim, self.input_dim),
-            dim1=-2, dim2=-1)  # shape: latent_dim x input_dim
-
-        diag1 = self.non_linearity_derivative(latent_output). \
-                    view(x.shape[0], self.latent_dim, self.input_dim, x.shape[-2], x.shape[-1]) \
-                * diag1[None, :, :, None, None]  # shape: B x latent_dim x input_dim x img_shape x img_shape
-
-        latent_output = self.non_linearity(latent_output)
-
         center1 = masked_weight1 * self.center_mask1  # shape: latent_dim.input_dim x input_dim x kernel x kernel
         center3 = masked_weight3 * self.center_mask3  # shape: input_dim x latent_dim.input_dim x kernel x kernel
 
@@ -231,160 +367,191 @@ class BasicBlock(nn.Module):
 
         masked_weight2 = (center2 * self.center_mask2 + self.weight2 * (1. - self.center_mask2)) * self.mask2
 
-        latent_output = F.conv2d(latent_output, masked_weight2, bias=self.bias2, padding=self.padding2, stride=1)
+        weights1, weights2, weights3 = self.conv.weights(masked_weight1, self.bias1, masked_weight2, self.bias2,
+                                                         masked_weight3, self.bias3)
+        t = torch.max(torch.abs(self.t), torch.tensor(1e-12, device=self.t.device))
+        if not with_log_det:
+            return weights1, weights2, weights3, None, t
+
+        kernel_mid_y, kernel_mid_x = masked_weight1.shape[-2] // 2, masked_weight1.shape[-1] // 2
+        diag1 = torch.diagonal(
+            masked_weight1[..., kernel_mid_y, kernel_mid_x].view(self.latent_dim, self.input_dim, self.input_dim),
+            dim1=-2, dim2=-1)  # shape: latent_dim x input_dim
 
         kernel_mid_y, kernel_mid_x = masked_weight2.shape[-2] // 2, masked_weight2.shape[-1] // 2
         diag2 = masked_weight2[..., kernel_mid_y, kernel_mid_x].view(self.latent_dim, self.input_dim, self.latent_dim,
                                                                      self.input_dim)
         diag2 = torch.diagonal(diag2.permute(0, 2, 1, 3), dim1=-2,
                                dim2=-1)  # shape: latent_dim x latent_dim x input_dim
-        diag2 = diag2[None, :, :, :, None, None]  # shape: 1 x latent_dim x latent_dim x input_dim x 1 x 1
-
-        diag2 = torch.sum(diag2 * diag1.unsqueeze(1),
-                          dim=2)  # shape: B x latent_dim x input_dim x img_shape x img_shape
-
-        latent_output_derivative = self.non_linearity_derivative(latent_output)
-        latent_output = self.non_linearity(latent_output)
-
-        latent_output = F.conv2d(latent_output, masked_weight3, bias=self.bias3, padding=self.padding3, stride=1)
 
         kernel_mid_y, kernel_mid_x = masked_weight3.shape[-2] // 2, masked_weight3.shape[-1] // 2
         diag3 = masked_weight3[..., kernel_mid_y, kernel_mid_x].view(self.input_dim, self.latent_dim, self.input_dim)
         diag3 = torch.diagonal(diag3.permute(1, 0, 2), dim1=-2, dim2=-1)  # shape: latent_dim x input_dim
-        diag3 = latent_output_derivative.view(x.shape[0], self.latent_dim, self.input_dim, x.shape[-2], x.shape[-1]) \
-                * diag3[None, :, :, None, None]  # shape: B x latent_dim x input_dim x img_shape x img_shape
 
-        diag = torch.sum(diag2 * diag3, dim=1)  # shape: B x input_dim x img_shape x img_shape
+        # shape: latent_dim x latent_dim x input_dim, see LogDetDiagonal
+        log_det_weight = diag3[:, None, :] * diag2 * diag1[None, :, :]
+        return weights1, weights2, weights3, log_det_weight, t
+
+    def masked_weights(self, with_log_det=True):
+        return cached_weights(self, (self.weight1, self.bias1, self.weight2, self.bias2, self.weight3, self.bias3,
+                                     self.t), partial(self._masked_weights, with_log_det), tag=with_log_det)
+
+    def log_det_diagonal(self, derivative1, derivative3, log_det_weight):
+        # shape: B x input_dim x img_shape x img_shape
+        diag = [LogDetDiagonal.apply(band_derivative1, band_derivative3, log_det_weight[..., start:end],
+                                     self.config.model.log_det_chunk_size, self.config.model.channels_last)
+                for band_derivative1, band_derivative3, (start, end) in
+                zip(self.conv.split(derivative1), self.conv.split(derivative3), self.conv.bands)]
+        return diag[0] if len(diag) == 1 else torch.cat(diag, dim=1)
+
+    def _apply(self, fn, *args, **kwargs):
+        self._weight_cache = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the masks were buffers still contain them, uncalibrated ones have no budget
+        # and no deviation
+        for name in MASK_NAMES:
+            state_dict.pop(prefix + name, None)
+        state_dict.setdefault(prefix + 'n_iters_budget', torch.zeros_like(self.n_iters_budget))
+        state_dict.setdefault(prefix + 'deviation', torch.full_like(self.deviation, float('inf')))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self._deviation = float(self.deviation)
+
+    def set_deviation(self, deviation):
+        self.deviation.fill_(deviation)
+        self._deviation = float(deviation)
+
+    @property
+    def scale_only(self):
+        # In evaluation, a block whose measured deviation is below analysis.skip_tol is replaced by its
+        # elementwise scale t * x, with log-det sum(log t) and inverse z / t
+        tol = self.config.analysis.skip_tol
+        return tol > 0 and not self.training and self._deviation <= tol
+
+    def scale_deviation(self, x):
+        # output of the block and the per sample relative distance ||f(x) - t * x|| / ||t * x||
+        output, _ = self.forward([x, None])
+        scaled = self.masked_weights(with_log_det=False)[-1] * x
+        deviation = (output - scaled).reshape(x.shape[0], -1).norm(dim=1) / scaled.reshape(x.shape[0], -1).norm(dim=1)
+        return output, deviation
 
-        t = torch.max(torch.abs(self.t), torch.tensor(1e-12, device=x.device))
+    def forward(self, x):
+        # log_det is None in encode mode (Net.forward(x, with_log_det=False)): only the output is computed
+        log_det = x[1]
+        x = x[0]
+        weights1, weights2, weights3, log_det_weight, t = self.masked_weights(with_log_det=log_det is not None)
+        if self.scale_only:
+            return t * x, None if log_det is None else log_det + torch.sum(torch.log(t))
+
+        # shape: B x latent_output . input_dim x img_size x img_size
+        latent_output = self.conv.conv_input(x, weights1, self.padding1)
+        if log_det is None:
+            latent_output = self.non_linearity(latent_output)
+        else:
+            latent_output, derivative1 = self.non_linearity_with_derivative(latent_output)
+
+        latent_output = self.conv.conv_latent(latent_output, weights2, self.padding2)
+        if log_det is None:
+            latent_output = self.non_linearity(latent_output)
+        else:
+            latent_output, derivative3 = self.non_linearity_with_derivative(latent_output)
+
+        latent_output = self.conv.conv_latent(latent_output, weights3, self.padding3)
         output = latent_output + t * x
+        if log_det is None:
+            return output, None
+
+        # shape: B x input_dim x img_shape x img_shape
+        diag = self.log_det_diagonal(derivative1, derivative3, log_det_weight)
         log_det += torch.sum(torch.log(diag + t), dim=(1, 2, 3))
 
         return output, log_det
 
-    def sampling(self, z):
-        with torch.no_grad():
-            masked_weight1 = self.weight1 * self.mask1
-            masked_weight3 = self.weight3 * self.mask3
-            center1 = masked_weight1 * self.center_mask1  # shape: latent_dim.input_dim x input_dim x kernel x kernel
-            center3 = masked_weight3 * self.center_mask3  # shape: input_dim x latent_dim.input_dim x kernel x kernel
-
-            # shape: 1 x latent_dim x input_dim x input_dim x kernel x kernel
-            center1 = center1.view(self.latent_dim, self.input_dim, self.input_dim,
-                                   center1.shape[-2], center1.shape[-1]).unsqueeze(0)
-            # shape: latent_dim x 1 x input_dim x input_dim x kernel x kernel
-            center3 = center3.view(self.input_dim, self.latent_dim, self.input_dim, center3.shape[-2],
-                                   center3.shape[-1]).permute(1, 0, 2, 3, 4).unsqueeze(1)
-
-            sign_prods = torch.sign(center1) * torch.sign(center3)
-            center2 = self.weight2 * self.center_mask2  # shape: latent_dim.input_dim x latent_dim.input_dim x kernel x kernel
-            center2 = center2.view(self.latent_dim, self.input_dim, self.latent_dim, self.input_dim,
-                                   center2.shape[-2], center2.shape[-1])
-
-            center2 = center2.permute(0, 2, 1, 3, 4, 5)
-            center2 = sign_prods * torch.abs(center2)
-            center2 = center2.permute(0, 2, 1, 3, 4, 5).contiguous().view_as(self.weight2)
-            masked_weight2 = (center2 * self.center_mask2 + self.weight2 * (1. - self.center_mask2)) * self.mask2
-
-            shared_t = torch.max(torch.abs(self.t), torch.tensor(1e-12, device=z.device))
-
-            kernel_mid_y, kernel_mid_x = masked_weight1.shape[-2] // 2, masked_weight1.shape[-1] // 2
-            diag1_share = torch.diagonal(
-                masked_weight1[..., kernel_mid_y, kernel_mid_x].view(self.latent_dim, self.input_dim,
-                                                                     self.input_dim),
-                dim1=-2, dim2=-1)[None, :, :, None, None]
-
-            kernel_mid_y, kernel_mid_x = masked_weight2.shape[-2] // 2, masked_weight2.shape[-1] // 2
-            diag2_share = masked_weight2[..., kernel_mid_y, kernel_mid_x].view(self.latent_dim, self.input_dim,
-                                                                               self.latent_dim,
-                                                                               self.input_dim)
-            diag2_share = torch.diagonal(diag2_share.permute(0, 2, 1, 3), dim1=-2,
-                                         dim2=-1)  # shape: latent_dim x latent_dim x input_dim
-            diag2_share = diag2_share[None, :, :, :, None,
-                          None]  # shape: 1 x latent_dim x latent_dim x input_dim x 1 x 1
-
-            kernel_mid_y, kernel_mid_x = masked_weight3.shape[-2] // 2, masked_weight3.shape[-1] // 2
-            diag3_share = masked_weight3[..., kernel_mid_y, kernel_mid_x].view(self.input_dim, self.latent_dim,
-                                                                               self.input_dim)
-            diag3_share = torch.diagonal(diag3_share.permute(1, 0, 2), dim1=-2, dim2=-1)[None, :, :, None, None]
-
-            def value_and_grad(x):
-                # shape: B x latent_output . input_dim x img_size x img_size
-                latent_output = F.conv2d(x, masked_weight1, bias=self.bias1, padding=self.padding1, stride=1)
-                diag1 = self.non_linearity_derivative(latent_output). \
-                            view(x.shape[0], self.latent_dim, self.input_dim, x.shape[-2], x.shape[-1]) \
-                        * diag1_share  # shape: B x latent_dim x input_dim x img_shape x img_shape
-                latent_output = self.non_linearity(latent_output)
-                latent_output = F.conv2d(latent_output, masked_weight2, bias=self.bias2, padding=self.padding2,
-                                         stride=1)
-                diag2 = torch.sum(diag2_share * diag1.unsqueeze(1),
-                                  dim=2)  # shape: B x latent_dim x input_dim x img_shape x img_shape
-                latent_output_derivative = self.non_linearity_derivative(latent_output)
-                latent_output = self.non_linearity(latent_output)
-                latent_output = F.conv2d(latent_output, masked_weight3, bias=self.bias3, padding=self.padding3,
-                                         stride=1)
-                diag3 = latent_output_derivative.view(x.shape[0], self.latent_dim, self.input_dim, x.shape[-2],
-                                                      x.shape[-1]) \
-                        * diag3_share  # shape: B x latent_dim x input_dim x img_shape x img_shape
-                diag = torch.sum(diag2 * diag3, dim=1)  # shape: B x input_dim x img_shape x img_shape
-                derivative = diag + shared_t  # shape: B x input_dim x img_shape x img_shape
-                output = latent_output + shared_t * x  # shape: B x input_dim x img_shape x img_shape
-                return output, derivative
-
-            if self.type == 'A':
-                print("type A")
-                x = z / shared_t  # [0,...]
-                for _ in tqdm(range(self.config.model.n_iters)):
-                    output, grad = value_and_grad(x)
-                    x += (z - output) / (self.config.analysis.newton_lr * grad)
-                return x
+    def low_precision_weights(self, dtype=torch.bfloat16):
+        def compute():
+            weights1, weights2, weights3, log_det_weight, t = self.masked_weights()
+            weights1, weights2, weights3 = [[(weight.to(dtype), bias.to(dtype)) for weight, bias in weights]
+                                            for weights in (weights1, weights2, weights3)]
+            return weights1, weights2, weights3, log_det_weight.to(dtype), t.to(dtype)
+
+        return cached_weights(self, (self.weight1, self.bias1, self.weight2, self.bias2, self.weight3, self.bias3,
+                                     self.t), compute, tag=dtype)
 
-            elif self.type == 'B':
-                print("type B")
-                x = z / shared_t  # [0,...]
-                for _ in tqdm(range(self.config.model.n_iters)):
-                    output, grad = value_and_grad(x)
-                    x += (z - output) / (self.config.analysis.newton_lr * grad)
+    def value_and_grad(self, weights, x, with_grad=True):
+        # f(x) and diag(J), with_grad=False only computes the value, which is what the chord iterations of the
+        # solvers need in between two evaluations of the diagonal derivative
+        weights1, weights2, weights3, log_det_weight, shared_t = weights
+        # shape: B x latent_output . input_dim x img_size x img_size
+        latent_output = self.conv.conv_input(x, weights1, self.padding1)
+        if with_grad:
+            latent_output, derivative1 = self.non_linearity_with_derivative(latent_output)
+        else:
+            latent_output = self.non_linearity(latent_output)
+        latent_output = self.conv.conv_latent(latent_output, weights2, self.padding2)
+        if with_grad:
+            latent_output, derivative3 = self.non_linearity_with_derivative(latent_output)
+        else:
+            latent_output = self.non_linearity(latent_output)
+        latent_output = self.conv.conv_latent(latent_output, weights3, self.padding3)
+        output = latent_output + shared_t * x  # shape: B x input_dim x img_shape x img_shape
+        if not with_grad:
+            return output, None
+
+        diag = self.log_det_diagonal(derivative1, derivative3, log_det_weight)
+        derivative = diag + shared_t  # shape: B x input_dim x img_shape x img_shape
+        return output, derivative
+
+    def sampling(self, z, return_stats=False):
+        with torch.no_grad():
+            weights = self.masked_weights()
+            if self.scale_only:
+                x = z / weights[-1]
+                if return_stats:
+                    n_iters = torch.zeros(z.shape[0], dtype=torch.long, device=z.device)
+                    return x, {'n_iters': n_iters, 'low_precision_iters': n_iters,
+                               'residual': torch.zeros(z.shape[0], dtype=z.dtype, device=z.device)}
                 return x
 
+            solver = get_solver(self.config)
+            n_iters = int(self.n_iters_budget) or self.config.model.n_iters
+            tol = self.config.analysis.residual_tol
+
+            x = z / weights[-1]  # [0,...]
+            low_precision_iters = min(self.config.analysis.low_precision_iters, n_iters)
+            if low_precision_iters > 0:
+                # The first iterations run in bfloat16. A sample leaves them early once it converged or its
+                # residual stalls (analysis.low_precision_stall), the remaining iterations refine it in fp32.
+                x, n_low_precision = solver(partial(self.value_and_grad, self.low_precision_weights()),
+                                            z.bfloat16(), x.bfloat16(), low_precision_iters, tol=tol,
+                                            stall=self.config.analysis.low_precision_stall)
+                x = x.to(z.dtype)
+                n_iters -= low_precision_iters
+            x, n_iters = solver(partial(self.value_and_grad, weights), z, x, n_iters, tol=tol)
+
+            if return_stats:
+                if low_precision_iters == 0:
+                    n_low_precision = torch.zeros_like(n_iters)
+                # final reconstruction error max |z - f(x)| of every sample
+                output, _ = self.value_and_grad(weights, x, with_grad=False)
+                residual = (z - output).abs().reshape(z.shape[0], -1).max(dim=1)[0]
+                return x, {'n_iters': n_iters + n_low_precision, 'low_precision_iters': n_low_precision,
+                           'residual': residual}
+            return x
 
 
 class SpaceToDepth(nn.Module):
-    def __init__(self, block_size):
+    def __init__(self, block_size, channels_last=False):
         super(SpaceToDepth, self).__init__()
         self.block_size = block_size
         self.block_size_sq = block_size * block_size
+        self.channels_last = channels_last
 
     def forward(self, x):
-        input = x[0]
-        output = input.permute(0, 2, 3, 1)
-        (batch_size, s_height, s_width, s_depth) = output.size()
-        d_depth = s_depth * self.block_size_sq
-        d_width = int(s_width / self.block_size)
-        d_height = int(s_height / self.block_size)
-        t_1 = output.split(self.block_size, 2)
-        stack = [t_t.reshape(batch_size, d_height, d_depth) for t_t in t_1]
-        output = torch.stack(stack, 1)
-        output = output.permute(0, 2, 1, 3)
-        output = output.permute(0, 3, 1, 2)
-        return output, x[1]
+        return space_to_depth(x[0], self.block_size, self.channels_last), x[1]
 
     def sampling(self, z):
-        with torch.no_grad():
-            input = z
-            output = input.permute(0, 2, 3, 1)
-            (batch_size, d_height, d_width, d_depth) = output.size()
-            s_depth = int(d_depth / self.block_size_sq)
-            s_width = int(d_width * self.block_size)
-            s_height = int(d_height * self.block_size)
-            t_1 = output.reshape(batch_size, d_height, d_width, self.block_size_sq, s_depth)
-            spl = t_1.split(self.block_size, 3)
-            stack = [t_t.reshape(batch_size, d_height, s_width, s_depth) for t_t in spl]
-            output = torch.stack(stack, 0).transpose(0, 1).permute(0, 2, 1, 3, 4).reshape(batch_size, s_height, s_width,
-                                                                                          s_depth)
-            output = output.permute(0, 3, 1, 2)
-            return output
-
+        return depth_to_space(z, self.block_size, self.channels_last)
 
 
 class Net(nn.Module):
@@ -408,7 +575,7 @@ class Net(nn.Module):
 
         for layer_num in range(self.n_layers):
             if layer_num in subsampling_anchors:
-                self.layers.append(SpaceToDepth(2))
+                self.layers.append(SpaceToDepth(2, config.model.channels_last))
                 channel *= 2 * 2
                 image_size = int(image_size / 2)
                 latent_size //= 2 * 2
@@ -424,6 +591,15 @@ class Net(nn.Module):
 
         self.sampling_shape = shape
 
+        if config.model.channels_last:
+            # NHWC weights and activations end to end, the views and reshapes in the blocks keep that layout
+            self.to(memory_format=torch.channels_last)
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        share_masks(self)
+        return self
+
     def _make_layer(self, shape, block_num, latent_dim, input_dim, init_zero):
         layers = []
         for i in range(0, block_num):
@@ -435,19 +611,37 @@ class Net(nn.Module):
 
         return SequentialWithSampling(*layers)
 
-    def forward(self, x):
-        log_det = torch.zeros(x.shape[0], device=x.device)
+    def forward(self, x, with_log_det=True):
+        # with_log_det=False only encodes x, the latents are the same and the log-det is None
+        if self.config.model.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
 
-        for layer in self.layers:
-            x, log_det = layer([x, log_det])
+        if with_log_det and self.config.training.reversible and torch.is_grad_enabled():
+            params = trainable_weights(self.layers)
+            x, log_det = ReversibleFlowFunction.apply(x, self.layers, *params)
+        else:
+            log_det = torch.zeros(x.shape[0], device=x.device) if with_log_det else None
+            for layer in self.layers:
+                x, log_det = layer([x, log_det])
 
         x = x.reshape(x.shape[0], -1)
         return x, log_det
 
-    def sampling(self, z):
+    def sampling(self, z, return_stats=False):
         z = z.view(z.shape[0], *self.sampling_shape)
+        if self.config.model.channels_last:
+            z = z.contiguous(memory_format=torch.channels_last)
         with torch.no_grad():
-            for layer in reversed(self.layers):
-                z = layer.sampling(z)
-
+            stats = []
+            for layer in tqdm(reversed(self.layers), total=len(self.layers)):
+                if return_stats and isinstance(layer, SequentialWithSampling):
+                    z, layer_stats = layer.sampling(z, return_stats=True)
+                    stats.append(layer_stats)
+                else:
+                    z = layer.sampling(z)
+
+            z = z.contiguous()
+            if return_stats:
+                # shape: B x n_blocks, columns in inversion order
+                return z, {key: torch.cat([s[key] for s in stats], dim=1) for key in stats[0]}
             return z
\ No newline at end of file
@@ -0,0 +1,167 @@
+import torch
+from functools import partial
+
+
+class ActiveSet(object):
+    # Keeps track of the samples of a batch that are still being iterated on. Solvers only carry the active
+    # samples (and their per-sample state) around, converged samples are written back to `out` once.
+    # With stall > 0 a sample also stops once its residual no longer shrinks below stall times the previous
+    # one, e.g. because the working precision is exhausted.
+    def __init__(self, x, tol, stall=0.):
+        self.out = x
+        self.tol = tol
+        self.stall = stall
+        self.index = None  # None while every sample is active
+        self.norm = None  # previous residual of the active samples, only tracked with stall > 0
+        self.n_iters = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+
+    @property
+    def done(self):
+        return self.index is not None and self.index.numel() == 0
+
+    def update(self, x, residual, *states):
+        if self.index is None:
+            self.n_iters += 1
+        else:
+            self.n_iters[self.index] += 1
+
+        if self.tol <= 0 and self.stall <= 0:
+            return (x,) + states
+
+        norm = residual.abs().reshape(residual.shape[0], -1).max(dim=1)[0]
+        not_converged = norm > self.tol
+        if self.stall > 0:
+            if self.norm is not None:
+                not_converged &= norm < self.stall * self.norm
+            self.norm = norm
+        if bool(not_converged.all()):
+            return (x,) + states
+
+        if self.index is None:
+            self.index = torch.arange(x.shape[0], device=x.device)
+        self.out[self.index[~not_converged]] = x[~not_converged]
+        self.index = self.index[not_converged]
+        if self.norm is not None:
+            self.norm = self.norm[not_converged]
+        return (x[not_converged],) + tuple(s[not_converged] for s in states)
+
+    def finish(self, x):
+        if self.index is None:
+            return x
+        self.out[self.index] = x
+        return self.out
+
+
+def _squared_norm(x):
+    return x.pow(2).reshape(x.shape[0], -1).sum(dim=1)
+
+
+def newton(value_and_grad, z, x, n_iters, tol=0., stall=0., lr=1., refresh=1):
+    # Damped diagonal Newton iterations x <- x + (z - f(x)) / (lr * diag(J)). diag(J) is only recomputed
+    # every `refresh` iterations (chord method), refresh=0 keeps the one of the starting point.
+    active = ActiveSet(x, tol, stall)
+    grad = None
+    for k in range(n_iters):
+        if grad is None or (refresh > 0 and k % refresh == 0):
+            output, grad = value_and_grad(x)
+        else:
+            output, _ = value_and_grad(x, with_grad=False)
+        residual = z - output
+        x += residual / (lr * grad)
+        x, z, grad = active.update(x, residual, z, grad)
+        if active.done:
+            break
+
+    return active.finish(x), active.n_iters
+
+
+def anderson(value_and_grad, z, x, n_iters, tol=0., stall=0., lr=1., refresh=1, memory=5, beta=1., lam=1e-4):
+    # Anderson acceleration of the diagonal Newton map g(x) = x + (z - f(x)) / (lr * diag(J)).
+    # Every sample solves its own least squares problem over the last `memory` iterates, in fp32 whatever
+    # the dtype of x.
+    batch_size = x.shape[0]
+    X = torch.zeros(batch_size, memory, x[0].numel(), dtype=x.dtype, device=x.device)
+    G = torch.zeros_like(X)
+    H = torch.zeros(batch_size, memory + 1, memory + 1, dtype=torch.float32, device=x.device)
+    H[:, 0, 1:] = H[:, 1:, 0] = 1.
+    y = torch.zeros(batch_size, memory + 1, 1, dtype=torch.float32, device=x.device)
+    y[:, 0] = 1.
+
+    active = ActiveSet(x, tol, stall)
+    x_k = x
+    grad = None
+    for k in range(n_iters):
+        if k > 0:
+            n = min(k, memory)
+            F = (G[:, :n] - X[:, :n]).float()
+            H[:, 1:n + 1, 1:n + 1] = torch.bmm(F, F.transpose(1, 2)) + \
+                                     lam * torch.eye(n, dtype=H.dtype, device=x.device)[None]
+            alpha = torch.linalg.solve(H[:, :n + 1, :n + 1], y[:, :n + 1])[:, 1:n + 1, 0].to(x.dtype)
+            x_k = beta * torch.bmm(alpha[:, None], G[:, :n])[:, 0] + \
+                  (1 - beta) * torch.bmm(alpha[:, None], X[:, :n])[:, 0]
+            x_k = x_k.view_as(x)
+
+        if grad is None or (refresh > 0 and k % refresh == 0):
+            output, grad = value_and_grad(x_k)
+        else:
+            output, _ = value_and_grad(x_k, with_grad=False)
+        residual = z - output
+        x = x_k + residual / (lr * grad)
+        X[:, k % memory] = x_k.reshape(x_k.shape[0], -1)
+        G[:, k % memory] = x.reshape(x.shape[0], -1)
+
+        x, z, grad, X, G, H, y = active.update(x, residual, z, grad, X, G, H, y)
+        if active.done:
+            break
+
+    return active.finish(x), active.n_iters
+
+
+def line_search(value_and_grad, z, x, n_iters, tol=0., stall=0., refresh=1, max_backtracks=5):
+    # Full diagonal Newton steps, halved per sample until the squared residual decreases. The trial points
+    # only evaluate diag(J) when the accepted one is due for a refresh (chord method, see `newton`).
+    active = ActiveSet(x, tol, stall)
+    output, grad = value_and_grad(x)
+    residual = z - output
+    for k in range(n_iters):
+        with_grad = refresh > 0 and (k + 1) % refresh == 0
+        norm = _squared_norm(residual)
+        direction = residual / grad
+        step = torch.ones_like(norm)
+
+        x_new = x + direction
+        output, grad_new = value_and_grad(x_new, with_grad=with_grad)
+        residual_new = z - output
+        for _ in range(max_backtracks):
+            rejected = torch.nonzero(_squared_norm(residual_new) >= norm).view(-1)
+            if rejected.numel() == 0:
+                break
+            step[rejected] *= 0.5
+            x_try = x[rejected] + step[rejected].view(-1, *([1] * (x.dim() - 1))) * direction[rejected]
+            output, grad_try = value_and_grad(x_try, with_grad=with_grad)
+            x_new[rejected] = x_try
+            residual_new[rejected] = z[rejected] - output
+            if with_grad:
+                grad_new[rejected] = grad_try
+
+        x, residual = x_new, residual_new
+        if with_grad:
+            grad = grad_new
+        x, z, residual, grad = active.update(x, residual, z, residual, grad)
+        if active.done:
+            break
+
+    return active.finish(x), active.n_iters
+
+
+def get_solver(config):
+    refresh = config.analysis.jacobian_refresh
+    if config.analysis.solver == 'newton':
+        return partial(newton, lr=config.analysis.newton_lr, refresh=refresh)
+    elif config.analysis.solver == 'anderson':
+        return partial(anderson, refresh=refresh, memory=config.analysis.anderson_memory,
+                       beta=config.analysis.anderson_beta)
+    elif config.analysis.solver == 'line_search':
+        return partial(line_search, refresh=refresh, max_backtracks=config.analysis.line_search_backtracks)
+    else:
+        raise NotImplementedError('Solver {} not understood.'.format(config.analysis.solver))
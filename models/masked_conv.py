@@ -0,0 +1,79 @@
+import torch
+import torch.nn.functional as F
+
+
+def channel_bands(input_dim, n_bands):
+    # Splits the input_dim colour channels into n_bands contiguous, nearly equal ranges
+    n_bands = max(1, min(n_bands, input_dim))
+    bounds = [input_dim * band // n_bands for band in range(n_bands + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class BandedMaskedConv(object):
+    # With rgb_last the masks are block triangular over the colour channels: in every latent group, output
+    # channel i only reads input channels j <= i (type A) or j >= i (type B). Once the colour channels are
+    # split into bands, the outputs of a band only need the inputs of the bands up to (A) or from (B) that
+    # band, so each masked convolution runs as n_bands narrower convolutions that skip the zero blocks.
+    #
+    # Latent activations are kept band-major: the channels of band 0 for every latent group, then band 1, and
+    # so on, so that the inputs of every band are a contiguous channel range. With a single band this is the
+    # plain dense convolution on the original channel order.
+    def __init__(self, input_dim, latent_dim, type, n_bands=1):
+        self.input_dim = input_dim
+        self.latent_dim = latent_dim
+        self.bands = channel_bands(input_dim, n_bands)
+
+        # original latent channels of every band, in band-major order
+        self.rows = [[l * input_dim + i for l in range(latent_dim) for i in range(start, end)]
+                     for start, end in self.bands]
+        self.permutation = [channel for rows in self.rows for channel in rows]
+
+        # colour channel range read by every band
+        if type == 'A':
+            self.inputs = [(0, end) for _, end in self.bands]
+        elif type == 'B':
+            self.inputs = [(start, input_dim) for start, _ in self.bands]
+        else:
+            raise TypeError('type should be either A or B')
+
+    @property
+    def dense(self):
+        return len(self.bands) == 1
+
+    def weights(self, masked_weight1, bias1, masked_weight2, bias2, masked_weight3, bias3):
+        # Per band (weight, bias) pairs of the three convolutions
+        if self.dense:
+            return [(masked_weight1, bias1)], [(masked_weight2, bias2)], [(masked_weight3, bias3)]
+
+        permutation = torch.tensor(self.permutation, device=masked_weight1.device)
+        weights1, weights2, weights3 = [], [], []
+        for (start, end), rows, (input_start, input_end) in zip(self.bands, self.rows, self.inputs):
+            rows = torch.tensor(rows, device=masked_weight1.device)
+            columns = permutation[self.latent_dim * input_start: self.latent_dim * input_end]
+            weights1.append((masked_weight1[rows, input_start:input_end], bias1[rows]))
+            weights2.append((masked_weight2[rows][:, columns], bias2[rows]))
+            weights3.append((masked_weight3[start:end][:, columns], bias3[start:end]))
+        return weights1, weights2, weights3
+
+    def conv_input(self, x, weights, padding):
+        # input_dim channels -> band-major latent channels
+        if self.dense:
+            weight, bias = weights[0]
+            return F.conv2d(x, weight, bias=bias, padding=padding, stride=1)
+        return torch.cat([F.conv2d(x[:, start:end], weight, bias=bias, padding=padding, stride=1)
+                          for (weight, bias), (start, end) in zip(weights, self.inputs)], dim=1)
+
+    def conv_latent(self, x, weights, padding):
+        # band-major latent channels -> band-major latent channels or, for the last convolution, input_dim channels
+        if self.dense:
+            weight, bias = weights[0]
+            return F.conv2d(x, weight, bias=bias, padding=padding, stride=1)
+        return torch.cat([F.conv2d(x[:, self.latent_dim * start:self.latent_dim * end], weight, bias=bias,
+                                   padding=padding, stride=1)
+                          for (weight, bias), (start, end) in zip(weights, self.inputs)], dim=1)
+
+    def split(self, x):
+        # band-major latent channels -> per band B x latent_dim x band_size x img_shape x img_shape views
+        return [x[:, self.latent_dim * start:self.latent_dim * end].view(x.shape[0], self.latent_dim, end - start,
+                                                                          x.shape[-2], x.shape[-1])
+                for start, end in self.bands]
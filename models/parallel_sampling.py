@@ -0,0 +1,200 @@
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+# model of the worker process, set by _init_worker
+_net = None
+
+
+def _init_worker(net, n_threads):
+    global _net
+    torch.set_num_threads(n_threads)
+    _net = net
+
+
+def _sample_shard(args):
+    z, return_stats = args
+    return _net.sampling(z, return_stats=return_stats)
+
+
+class ProcessPoolSampler(object):
+    # Net.sampling on CPU with the batch split into shards that a pool of worker processes invert in parallel.
+    # The net is moved to shared memory (net.share_memory()) so that the workers map its parameters instead of
+    # copying them, and every worker is limited to n_threads intra-op threads. Latents and samples travel
+    # through shared memory as well. If a worker dies (e.g. out of memory), sampling raises BrokenProcessPool.
+    def __init__(self, net, n_workers=0, n_threads=1, shard_size=0):
+        if isinstance(net, nn.DataParallel):
+            net = net.module
+        self.net = net.cpu().share_memory()
+        self.n_workers = n_workers or max(1, os.cpu_count() // n_threads)
+        self.shard_size = shard_size
+        self.pool = ProcessPoolExecutor(self.n_workers, mp_context=mp.get_context('spawn'),
+                                        initializer=_init_worker, initargs=(self.net, n_threads))
+
+    def sampling(self, z, return_stats=False):
+        shard_size = self.shard_size or -(-z.shape[0] // self.n_workers)
+        outputs = list(self.pool.map(_sample_shard, [(shard, return_stats) for shard in z.cpu().split(shard_size)]))
+        if not return_stats:
+            return torch.cat(outputs, dim=0)
+
+        samples, stats = zip(*outputs)
+        return torch.cat(samples, dim=0), {key: torch.cat([s[key] for s in stats], dim=0) for key in stats[0]}
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _pipeline_stage(layers, in_queue, out_queue, n_threads):
+    # Inverts the micro-batches coming from in_queue with `layers` (in inversion order) and passes them on. A
+    # failed micro-batch is passed on as its traceback, None shuts the stage down.
+    torch.set_num_threads(n_threads)
+    with torch.no_grad():
+        while True:
+            item = in_queue.get()
+            if item is not None and not isinstance(item[1], str):
+                index, z = item
+                try:
+                    for layer in layers:
+                        z = layer.sampling(z)
+                except Exception:
+                    z = traceback.format_exc()
+                item = (index, z)
+            out_queue.put(item)
+            if item is None:
+                break
+
+
+def layer_cost(layer):
+    # Rough multiply-adds of one evaluation of a layer per sample, the masked convolutions dominate
+    cost = 0
+    for block in layer.modules():
+        if hasattr(block, 'mask_key'):
+            input_dim, latent_dim = block.input_dim, block.latent_dim
+            cost += (input_dim * latent_dim * input_dim * (block.kernel1 ** 2 + block.kernel3 ** 2) +
+                     (input_dim * latent_dim) ** 2 * block.kernel2 ** 2) * block.shape[1] * block.shape[2]
+    return cost
+
+
+def partition_layers(layers, n_stages):
+    # Splits `layers` into at most n_stages contiguous groups of about the same total layer_cost
+    costs = [layer_cost(layer) for layer in layers]
+    total, cumulative = sum(costs), 0
+    stages = [[] for _ in range(n_stages)]
+    for layer, cost in zip(layers, costs):
+        # a layer goes to the stage its cost midpoint falls in
+        stage = min(int((cumulative + cost / 2) * n_stages / max(total, 1)), n_stages - 1)
+        stages[stage].append(layer)
+        cumulative += cost
+    return [stage for stage in stages if stage]
+
+
+class PipelineSampler(object):
+    # Net.sampling on CPU as a pipeline: the layers are split (in inversion order) into n_stages groups of
+    # similar cost, every group is owned by a worker process, and micro-batches of the latents stream through
+    # the stages so that all of them work at the same time. Queues between the stages hold at most
+    # queue_size micro-batches, which bounds the memory in flight. The queues are polled every poll_interval
+    # seconds, and if a stage process died (e.g. killed when out of memory) the pipeline is torn down and
+    # sampling raises instead of waiting forever.
+    poll_interval = 1.
+
+    def __init__(self, net, n_stages, micro_batch_size, n_threads=1, queue_size=2):
+        if isinstance(net, nn.DataParallel):
+            net = net.module
+        self.net = net.cpu().share_memory()
+        self.micro_batch_size = micro_batch_size
+        self.error = None
+
+        stages = partition_layers(list(reversed(self.net.layers)), n_stages)
+        context = mp.get_context('spawn')
+        self.queues = [context.Queue(queue_size) for _ in range(len(stages) + 1)]
+        self.processes = [context.Process(target=_pipeline_stage, daemon=True,
+                                          args=(nn.ModuleList(layers), in_queue, out_queue, n_threads))
+                          for layers, in_queue, out_queue in zip(stages, self.queues[:-1], self.queues[1:])]
+        for process in self.processes:
+            process.start()
+
+    def _check_stages(self):
+        # a dead stage breaks the pipeline: the other stages are terminated and the queues abandoned, so that
+        # neither this process nor its exit waits for items that will never be consumed
+        for i, process in enumerate(self.processes):
+            if self.error is None and process.exitcode not in (None, 0):
+                self.error = 'Pipeline stage {} died with exit code {}'.format(i, process.exitcode)
+                for other in self.processes:
+                    other.terminate()
+                for q in self.queues:
+                    q.cancel_join_thread()
+        if self.error is not None:
+            raise RuntimeError(self.error)
+
+    def _put(self, item):
+        while True:
+            try:
+                return self.queues[0].put(item, timeout=self.poll_interval)
+            except queue.Full:
+                self._check_stages()
+
+    def _get(self):
+        while True:
+            try:
+                return self.queues[-1].get(timeout=self.poll_interval)
+            except queue.Empty:
+                self._check_stages()
+
+    def sampling(self, z):
+        self._check_stages()
+        z = z.cpu().view(z.shape[0], *self.net.sampling_shape)
+        if self.net.config.model.channels_last:
+            z = z.contiguous(memory_format=torch.channels_last)
+        micro_batches = z.split(self.micro_batch_size)
+
+        # feed from a thread, the bounded queues would otherwise block before any output is collected
+        def feed():
+            try:
+                for item in enumerate(micro_batches):
+                    self._put(item)
+            except RuntimeError:
+                # a stage died, sampling raises
+                pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        outputs = [None] * len(micro_batches)
+        error = None
+        for _ in range(len(micro_batches)):
+            # after a failure the remaining micro-batches are still collected, so that the pipeline is empty
+            # and close() can shut the stages down
+            index, x = self._get()
+            if isinstance(x, str):
+                error = error or x
+            outputs[index] = x
+        feeder.join()
+        if error is not None:
+            raise RuntimeError('Pipeline stage failed:\n' + error)
+        return torch.cat(outputs, dim=0).contiguous()
+
+    def close(self):
+        if self.error is not None:
+            # already torn down
+            return
+        self._put(None)
+        while self._get() is not None:
+            pass
+        for process in self.processes:
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
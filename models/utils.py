@@ -1,63 +1,170 @@
-from numba import jit
 import torch
 import torch.nn as nn
+import numpy as np
 import copy
+import os
 
-@jit(nopython=True)
-def fill_mask(mask, type, rgb_last=True):
-    input_dim = mask.shape[0]
-    kernel_mid_y = mask.shape[-2] // 2
-    kernel_mid_x = mask.shape[-1] // 2
-    if rgb_last:
-        if type == 'A':
-            for i in range(input_dim):
-                mask[i, i + 1:, :, :] = 0.0
-                mask[i, i, kernel_mid_y + 1:, :] = 0.0
-                mask[i, i, kernel_mid_y, kernel_mid_x + 1:] = 0.0
-        if type == 'B':
-            for i in range(input_dim):
-                mask[i, :i, :, :] = 0.0
-                mask[i, i, :kernel_mid_y, :] = 0.0
-                mask[i, i, kernel_mid_y, :kernel_mid_x] = 0.0
+
+def _block_masks(input_dim, kernel, type, rgb_last):
+    # Autoregressive mask of a single input_dim x input_dim x kernel x kernel block of the masked convolutions,
+    # and the mask of its diagonal centre entries
+    i = np.arange(input_dim)[:, None, None, None]  # output channel
+    j = np.arange(input_dim)[None, :, None, None]  # input channel
+    y = np.arange(kernel)[None, None, :, None]
+    x = np.arange(kernel)[None, None, None, :]
+    kernel_mid = kernel // 2
+
+    if rgb_last and type == 'A':
+        zero = (j > i) | ((j == i) & (y > kernel_mid)) | ((j == i) & (y == kernel_mid) & (x > kernel_mid))
+    elif rgb_last and type == 'B':
+        zero = (j < i) | ((j == i) & (y < kernel_mid)) | ((j == i) & (y == kernel_mid) & (x < kernel_mid))
+    elif type == 'A':
+        zero = (y > kernel_mid) | ((j <= i) & (y == kernel_mid) & (x > kernel_mid)) | \
+               ((j > i) & (y == kernel_mid) & (x >= kernel_mid))
+    elif type == 'B':
+        zero = (y < kernel_mid) | ((j >= i) & (y == kernel_mid) & (x < kernel_mid)) | \
+               ((j < i) & (y == kernel_mid) & (x <= kernel_mid))
     else:
-        if type == 'A':
-            for i in range(input_dim):
-                mask[i, :, kernel_mid_y + 1:, :] = 0.0
-                # For the current and previous color channels, including the current color
-                mask[i, :i + 1, kernel_mid_y, kernel_mid_x + 1:] = 0.0
-                # For the latter color channels, not including the current color
-                mask[i, i + 1:, kernel_mid_y, kernel_mid_x:] = 0.0
-
-        elif type == 'B':
-            for i in range(input_dim):
-                mask[i, :, :kernel_mid_y, :] = 0.0
-                # For the current and latter color channels, including the current color
-                mask[i, i:, kernel_mid_y, :kernel_mid_x] = 0.0
-                # For the previous color channels, not including the current color
-                mask[i, :i, kernel_mid_y, :kernel_mid_x + 1] = 0.0
+        raise TypeError('type should be either A or B')
+
+    mask = np.broadcast_to(~zero, (input_dim, input_dim, kernel, kernel)).astype(np.float32)
+    center_mask = ((i == j) & (y == kernel_mid) & (x == kernel_mid)).astype(np.float32)
+    return mask, center_mask
+
+
+_masks = {}
+
+
+def get_masks(input_dim, latent_dim, type, rgb_last, kernel1, kernel2, kernel3, cache_dir=None):
+    # Masks of a BasicBlock, returned as (mask1, center_mask1, mask2, center_mask2, mask3, center_mask3).
+    # They are memoized per process and, with cache_dir, stored as .npz files. The arrays are shared, so they
+    # are read-only.
+    key = (input_dim, latent_dim, type, rgb_last, kernel1, kernel2, kernel3)
+    if key in _masks:
+        return _masks[key]
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, 'masks_{}_{}_{}_{}_{}_{}_{}.npz'.format(*key))
+
+    if path is not None and os.path.exists(path):
+        with np.load(path) as f:
+            masks = tuple(f['arr_{}'.format(i)] for i in range(6))
+    else:
+        mask1, center_mask1 = _block_masks(input_dim, kernel1, type, rgb_last)
+        mask2, center_mask2 = _block_masks(input_dim, kernel2, type, rgb_last)
+        mask3, center_mask3 = _block_masks(input_dim, kernel3, type, rgb_last)
+        masks = (np.tile(mask1, (latent_dim, 1, 1, 1)), np.tile(center_mask1, (latent_dim, 1, 1, 1)),
+                 np.tile(mask2, (latent_dim, latent_dim, 1, 1)), np.tile(center_mask2, (latent_dim, latent_dim, 1, 1)),
+                 np.tile(mask3, (1, latent_dim, 1, 1)), np.tile(center_mask3, (1, latent_dim, 1, 1)))
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, *masks)
+            os.replace(path + '.tmp', path)
+
+    for mask in masks:
+        mask.setflags(write=False)
+    _masks[key] = masks
+    return masks
+
+
+MASK_NAMES = ('mask1', 'center_mask1', 'mask2', 'center_mask2', 'mask3', 'center_mask3')
+
+# order of BasicBlock._parameters from when the masks were nn.Parameters, see legacy_optimizer_state_dict
+LEGACY_BLOCK_PARAMETERS = ('weight1', 'bias1', 'weight2', 'bias2', 'weight3', 'bias3') + MASK_NAMES + ('t',)
+
+_mask_tensors = {}
+
+
+def get_mask_tensors(input_dim, latent_dim, type, rgb_last, kernel1, kernel2, kernel3, cache_dir=None):
+    # get_masks as tensors. Every block of the same shape and type gets the very same tensors, which it keeps
+    # as non-persistent buffers.
+    key = (input_dim, latent_dim, type, rgb_last, kernel1, kernel2, kernel3)
+    if key not in _mask_tensors:
+        _mask_tensors[key] = tuple(torch.tensor(mask) for mask in get_masks(*key, cache_dir=cache_dir))
+    return _mask_tensors[key]
+
+
+def share_masks(module):
+    # Module._apply (.to(), .cuda(), .half() ...) converts the buffers of every block separately. Makes the
+    # blocks with the same mask_key point to a single copy again.
+    shared = {}
+    for m in module.modules():
+        mask_key = getattr(m, 'mask_key', None)
+        if mask_key is None:
+            continue
+        for name in MASK_NAMES:
+            mask = m._buffers[name]
+            m._buffers[name] = shared.setdefault((mask_key, name, mask.device, mask.dtype), mask)
+
+
+def legacy_optimizer_state_dict(state_dict, module):
+    # Optimizer states saved while the masks were nn.Parameters contain six extra (stateless) parameters per
+    # block. Drops them so that the state dict can be loaded by an optimizer over module.parameters().
+    if isinstance(module, nn.DataParallel):
+        module = module.module
+
+    is_mask = []
+    for m in module.modules():
+        if getattr(m, 'mask_key', None) is not None:
+            is_mask += [name in MASK_NAMES for name in LEGACY_BLOCK_PARAMETERS]
         else:
-            raise TypeError('type should be either A or B')
-
-@jit(nopython=True)
-def fill_center_mask(mask):
-    input_dim = mask.shape[0]
-    kernel_mid_y = mask.shape[-2] // 2
-    kernel_mid_x = mask.shape[-1] // 2
-    for i in range(input_dim):
-        mask[i, i, kernel_mid_y, kernel_mid_x] = 1.0
-
-@jit(nopython=True)
-def generate_masks(mask1, center_mask1, mask2, center_mask2, mask3, center_mask3, input_dim, latent_dim, type, rgb_last):
-    for i in range(latent_dim):
-        fill_mask(mask1[i * input_dim: (i + 1) * input_dim, ...], type=type, rgb_last=rgb_last)
-        fill_center_mask(center_mask1[i * input_dim: (i + 1) * input_dim, ...])
-        fill_mask(mask3[:, i * input_dim: (i + 1) * input_dim, ...], type=type, rgb_last=rgb_last)
-        fill_center_mask(center_mask3[:, i * input_dim: (i + 1) * input_dim, ...])
-        for j in range(latent_dim):
-            fill_mask(mask2[i * input_dim: (i + 1) * input_dim, j * input_dim: (j + 1) * input_dim, ...],
-                      type=type, rgb_last=rgb_last)
-            fill_center_mask(
-                center_mask2[i * input_dim: (i + 1) * input_dim, j * input_dim: (j + 1) * input_dim, ...])
+            is_mask += [False for p in m._parameters.values() if p is not None]
+
+    saved_ids = [i for group in state_dict['param_groups'] for i in group['params']]
+    if len(saved_ids) != len(is_mask):
+        return state_dict
+
+    mask_ids = {i for i, mask in zip(saved_ids, is_mask) if mask}
+    state_dict = dict(state_dict)
+    state_dict['state'] = {i: s for i, s in state_dict['state'].items() if i not in mask_ids}
+    state_dict['param_groups'] = [dict(group, params=[i for i in group['params'] if i not in mask_ids])
+                                  for group in state_dict['param_groups']]
+    return state_dict
+
+
+def cached_weights(module, parameters, compute, tag=None):
+    # Tensors derived from the parameters (masked weights etc.) are reused while autograd is off and none of
+    # `parameters` has been modified in-place or replaced since they were computed. `tag` tells apart
+    # different things computed from the same parameters.
+    if torch.is_grad_enabled():
+        return compute()
+
+    key = tuple((p._version, p.data_ptr()) for p in parameters)
+    if module._weight_cache is None:
+        module._weight_cache = {}
+    entry = module._weight_cache.get(tag)
+    if entry is None or entry[0] != key:
+        entry = module._weight_cache[tag] = (key, compute())
+    return entry[1]
+
+
+def space_to_depth(x, block_size, channels_last=False):
+    # B x C x H x W -> B x block_size.block_size.C x H / block_size x W / block_size, the output channels are
+    # ordered (row in block, column in block, input channel). With channels_last the work happens on the
+    # NHWC view of x, which is free (and the output is channels last) when x is in torch.channels_last format.
+    batch_size, channels, height, width = x.shape
+    d_height, d_width = height // block_size, width // block_size
+    if channels_last:
+        x = x.permute(0, 2, 3, 1).reshape(batch_size, d_height, block_size, d_width, block_size, channels)
+        x = x.permute(0, 1, 3, 2, 4, 5).reshape(batch_size, d_height, d_width, -1)
+        return x.permute(0, 3, 1, 2)
+    x = x.reshape(batch_size, channels, d_height, block_size, d_width, block_size)
+    return x.permute(0, 3, 5, 1, 2, 4).reshape(batch_size, -1, d_height, d_width)
+
+
+def depth_to_space(x, block_size, channels_last=False):
+    # Inverse of space_to_depth
+    batch_size, d_channels, d_height, d_width = x.shape
+    channels = d_channels // (block_size * block_size)
+    height, width = d_height * block_size, d_width * block_size
+    if channels_last:
+        x = x.permute(0, 2, 3, 1).reshape(batch_size, d_height, d_width, block_size, block_size, channels)
+        x = x.permute(0, 1, 3, 2, 4, 5).reshape(batch_size, height, width, channels)
+        return x.permute(0, 3, 1, 2)
+    x = x.reshape(batch_size, block_size, block_size, channels, d_height, d_width)
+    return x.permute(0, 3, 4, 1, 5, 2).reshape(batch_size, channels, height, width)
 
 
 class EMAHelper(object):
@@ -82,9 +189,10 @@ class EMAHelper(object):
     def ema(self, module):
         if isinstance(module, nn.DataParallel):
             module = module.module
-        for name, param in module.named_parameters():
-            if param.requires_grad:
-                param.data.copy_(self.shadow[name].data)
+        with torch.no_grad():
+            for name, param in module.named_parameters():
+                if param.requires_grad:
+                    param.copy_(self.shadow[name].data)
 
     def ema_copy(self, module):
         module_copy = copy.deepcopy(module)
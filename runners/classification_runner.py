@@ -119,7 +119,7 @@ class ClassificationRunner(object):
             states = torch.load(os.path.join(self.args.run, 'logs', self.args.doc, 'checkpoint.pth'),
                                 map_location=self.config.device)
             net.load_state_dict(states[0])
-            optimizer.load_state_dict(states[1])
+            optimizer.load_state_dict(legacy_optimizer_state_dict(states[1], net))
             begin_epoch = states[2]
             step = states[3]
         else:
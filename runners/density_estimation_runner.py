@@ -1,4 +1,4 @@
-from models.cnn_flow import Net
+from models.cnn_flow import Net, BasicBlock, SpaceToDepth
 from torch.nn.utils import clip_grad_norm_, clip_grad_value_
 import shutil
 import tensorboardX
@@ -11,8 +11,10 @@ import numpy as np
 import torch.optim as optim
 import os
 from models.cnn_flow import DataParallelWithSampling
+from models.parallel_sampling import ProcessPoolSampler, PipelineSampler
 from torchvision.utils import save_image, make_grid
 from datasets.imagenet import OordImageNet
+from datasets.images import image_dataset
 import torch.autograd as autograd
 import torch
 import matplotlib.pyplot as plt
@@ -20,7 +22,13 @@ import tqdm
 import seaborn as sns
 import math
 import pickle
-from models.utils import EMAHelper
+import time
+import contextlib
+import copy
+from models.utils import EMAHelper, legacy_optimizer_state_dict
+from runners.utils import ResumableNpyWriter, RunningStats, to_uint8
+from runners.server import DynamicBatcher, serve, load_test
+from runners.latent_store import LatentStore, arrays_hash
 sns.set()
 
 
@@ -117,6 +125,16 @@ class DensityEstimationRunner(object):
                 loss /= u.size(0)
             return loss
 
+        def snapshot_bpd():
+            # anytime test bpd estimate of a snapshot (see estimate_bpd), comparable across snapshots unlike the
+            # single batch estimates of every log_interval
+            net_test = ema_helper.ema_copy(net) if self.config.training.ema else net
+            net_test.eval()
+            stats = self.estimate_bpd(net_test, test_dataset)
+            tb_logger.add_scalar('snapshot_test_bpd', stats.mean, global_step=step)
+            logging.info("step: {}, snapshot test bpd: {:.5f} +- {:.5f} from {} images".format(
+                step, stats.mean, stats.ci_width(self.config.evaluation.confidence) / 2, stats.n))
+
         if self.config.data.dataset == 'ImageNet':
             scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, self.config.training.maximum_steps, eta_min=0.)
         elif self.config.data.dataset == 'MNIST':
@@ -129,7 +147,13 @@ class DensityEstimationRunner(object):
                                 map_location=self.config.device)
 
             net.load_state_dict(states[0])
-            optimizer.load_state_dict(states[1])
+            # iteration budgets of the calibrate task and deviations of the skip_analysis task only hold for the
+            # weights they were measured on
+            for module in net.modules():
+                if isinstance(module, BasicBlock):
+                    module.n_iters_budget.zero_()
+                    module.set_deviation(float('inf'))
+            optimizer.load_state_dict(legacy_optimizer_state_dict(states[1], net))
             begin_epoch = states[2]
             step = states[3]
             scheduler.load_state_dict(states[4])
@@ -218,6 +242,8 @@ class DensityEstimationRunner(object):
                         torch.save(states, os.path.join(self.args.run, 'logs', self.args.doc,
                                                         'checkpoint_batch_{}.pth'.format(step)))
                         torch.save(states, os.path.join(self.args.run, 'logs', self.args.doc, 'checkpoint.pth'))
+                        if self.config.training.snapshot_bpd:
+                            snapshot_bpd()
 
                     if step == self.config.training.maximum_steps:
                         states = [
@@ -251,13 +277,21 @@ class DensityEstimationRunner(object):
                 torch.save(states, os.path.join(self.args.run, 'logs', self.args.doc,
                                                 'checkpoint_epoch_{}.pth'.format(epoch + 1)))
                 torch.save(states, os.path.join(self.args.run, 'logs', self.args.doc, 'checkpoint.pth'))
+                if self.config.training.snapshot_bpd:
+                    snapshot_bpd()
 
 
-    def test(self):
-        import time
-        torch.cuda.synchronize()
-        start_time = time.time()
+    def get_input_dataset(self):
+        # Images of --input, resized (shorter side) and center cropped to image_size x image_size since image
+        # directories may hold images of any size and aspect ratio
+        transform = transforms.Compose([
+            transforms.Resize(self.config.data.image_size),
+            transforms.CenterCrop(self.config.data.image_size),
+            transforms.ToTensor()
+        ])
+        return image_dataset(self.args.input, self.config.data.channels, transform=transform)
 
+    def get_test_dataset(self):
         transform = transforms.Compose([
             transforms.Resize(self.config.data.image_size),
             transforms.ToTensor()
@@ -290,6 +324,14 @@ class DensityEstimationRunner(object):
             train_indices, test_indices = indices[:int(num_items * 0.7)], indices[
                                                                           int(num_items * 0.7):int(num_items * 0.8)]
             test_dataset = Subset(dataset, test_indices)
+        return test_dataset
+
+    def test(self):
+        import time
+        torch.cuda.synchronize()
+        start_time = time.time()
+
+        test_dataset = self.get_test_dataset()
 
         test_loader = DataLoader(test_dataset, batch_size=self.config.training.batch_size, shuffle=True,
                                  num_workers=4, drop_last=False)
@@ -309,11 +351,10 @@ class DensityEstimationRunner(object):
                 loss /= u.size(0)
             return loss
 
-        states = torch.load(os.path.join(self.args.run, 'logs', self.args.doc, 'checkpoint.pth'),
-                            map_location=self.config.device)
+        states = torch.load(self.checkpoint_path(), map_location=self.config.device)
 
         net.load_state_dict(states[0])
-        optimizer.load_state_dict(states[1])
+        optimizer.load_state_dict(legacy_optimizer_state_dict(states[1], net))
         loaded_epoch = states[2]
         if self.config.training.ema:
             ema_helper.load_state_dict(states[5])
@@ -331,7 +372,11 @@ class DensityEstimationRunner(object):
         logging.info("Generating samples")
         z = torch.randn(64, self.config.data.channels * self.config.data.image_size * self.config.data.image_size,
                        device=self.config.device)
-        samples = net.sampling(z)
+        samples, stats = net.sampling(z, return_stats=True)
+        logging.info("Inversion iterations per block: {}".format(stats['n_iters'].float().mean(dim=0).tolist()))
+        logging.info("bfloat16 iterations per block: {}".format(
+            stats['low_precision_iters'].float().mean(dim=0).tolist()))
+        logging.info("Max reconstruction error per block: {}".format(stats['residual'].max(dim=0)[0].tolist()))
         samples = self.sigmoid_transform(samples)
 
         samples = make_grid(samples, 8)
@@ -365,3 +410,436 @@ class DensityEstimationRunner(object):
         time_taken = time.time() - start_time
         print("Run-Time: %.4f s" % time_taken)
 
+    def checkpoint_path(self):
+        # --checkpoint (default: checkpoint.pth), relative to the log directory of this run
+        return os.path.join(self.args.run, 'logs', self.args.doc, self.args.checkpoint)
+
+    def load_net(self, config=None):
+        # Network of --checkpoint of this run, with the EMA weights if used, ready for evaluation
+        net = Net(config or self.config).to(self.config.device)
+        net = DataParallelWithSampling(net)
+        states = torch.load(self.checkpoint_path(), map_location=self.config.device)
+        net.load_state_dict(states[0])
+        if self.config.training.ema:
+            ema_helper = EMAHelper(mu=0.999)
+            ema_helper.load_state_dict(states[5])
+            ema_helper.ema(net)
+        logging.info("Loading the model from epoch {}".format(states[2]))
+
+        net.eval()
+        return net
+
+    def sample(self):
+        # Generates sampling.n_samples samples in batches of sampling.batch_size into a uint8 N x H x W x C .npy
+        # file. Rerunning the task resumes an interrupted run.
+        net = self.load_net()
+        n_samples = self.config.sampling.n_samples
+        batch_size = self.config.sampling.batch_size
+        image_size, channels = self.config.data.image_size, self.config.data.channels
+        path = self.config.sampling.output or os.path.join(self.args.run, 'samples',
+                                                           '{}_samples.npy'.format(self.args.doc))
+
+        writer = ResumableNpyWriter(path, (n_samples, image_size, image_size, channels), np.uint8)
+        if writer.n_done > 0:
+            logging.info("Resuming from {} / {} samples".format(writer.n_done, n_samples))
+
+        # the worker processes of the CPU samplers are shut down on exit, also if a batch fails
+        with contextlib.ExitStack() as workers:
+            if self.config.sampling.n_stages > 0:
+                # streams micro-batches through CPU worker processes that own consecutive layers
+                net = workers.enter_context(PipelineSampler(net, self.config.sampling.n_stages,
+                                                            self.config.sampling.micro_batch_size,
+                                                            self.config.sampling.n_threads))
+            elif self.config.sampling.n_workers > 0:
+                # shards every batch over CPU worker processes
+                net = workers.enter_context(ProcessPoolSampler(net, self.config.sampling.n_workers,
+                                                               self.config.sampling.n_threads))
+
+            start_time = time.time()
+            n_generated = 0
+            while not writer.done:
+                start = writer.n_done
+                end = min(start + batch_size, n_samples)
+                # one generator per batch, so a resumed run draws the same latents as an uninterrupted one
+                seed = int(np.random.SeedSequence([self.config.sampling.seed, start]).generate_state(1)[0])
+                generator = torch.Generator().manual_seed(seed)
+                z = torch.randn(end - start, channels * image_size * image_size, generator=generator)
+                z = z.to(self.config.device) * self.config.sampling.temperature
+
+                samples = self.sigmoid_transform(net.sampling(z))
+                writer.write(to_uint8(samples))
+
+                n_generated += end - start
+                logging.info("{} / {} samples, {:.2f} samples/sec".format(writer.n_done, n_samples,
+                                                                          n_generated / (time.time() - start_time)))
+        logging.info("Samples written to {}".format(path))
+
+    def preprocess(self, data, noise=True):
+        # uint8-valued images in [0, 1] -> uniformly dequantized logits, the inputs of the model. noise=False
+        # takes the centres of the quantization bins instead, which is deterministic.
+        data = data.to(self.config.device) * 255. / 256.
+        if noise:
+            data += torch.rand_like(data) / 256.
+        else:
+            data += 0.5 / 256.
+        return self.logit_transform(data)
+
+    def bits_per_dim(self, data, output, log_det):
+        # Per sample bpd of the logits `data` of dequantized images, given the latents and log-det of the model
+        n_dims = np.prod(data.shape[1:])
+        log_det_logit = (F.softplus(-data) + F.softplus(data)).reshape(data.shape[0], -1).sum(dim=1) + \
+                        n_dims * np.log(1 - 2 * self.config.data.lambda_logit)
+        log_probs = (-0.5 * output.pow(2) - 0.5 * np.log(2 * np.pi)).reshape(output.shape[0], -1).sum(dim=1)
+        return (-(log_probs + log_det) - log_det_logit) / (np.log(2) * n_dims) + 8
+
+    def update_checkpoint(self, net, buffer_name):
+        # Writes the `buffer_name` buffers of net into --checkpoint of this run. Nothing else changes, in
+        # particular the weights stay the raw (non-EMA) ones.
+        path = self.checkpoint_path()
+        states = torch.load(path, map_location=self.config.device)
+        states[0].update({key: value for key, value in net.state_dict().items() if key.endswith(buffer_name)})
+        # written next to the checkpoint first, so an interrupted write leaves the checkpoint intact
+        torch.save(states, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        logging.info("{} saved to {}".format(buffer_name, path))
+
+    def calibrate(self):
+        # Measures how many iterations every block needs to invert the latents of test images to a residual of
+        # analysis.calibration_tol, and stores them in the checkpoint as the blocks' n_iters_budget
+        config = copy.deepcopy(self.config)
+        config.model.n_iters = config.analysis.calibration_max_iters
+        config.analysis.residual_tol = config.analysis.calibration_tol
+        net = self.load_net(config)
+        blocks = [module for module in net.modules() if isinstance(module, BasicBlock)]
+        for block in blocks:
+            block.n_iters_budget.zero_()
+
+        test_loader = DataLoader(self.get_test_dataset(), batch_size=self.config.training.batch_size, shuffle=True,
+                                 num_workers=4, drop_last=False)
+        n_iters, residuals = [], []
+        n_data = 0
+        with torch.no_grad():
+            for test_data, _ in test_loader:
+                z, _ = net(self.preprocess(test_data), with_log_det=False)
+                _, stats = net.sampling(z, return_stats=True)
+                n_iters.append(stats['n_iters'].cpu())
+                residuals.append(stats['residual'].cpu())
+                n_data += test_data.shape[0]
+                if n_data >= config.analysis.calibration_samples:
+                    break
+
+        # shape: N x n_blocks, columns in inversion order, i.e. blocks in reverse
+        n_iters, residuals = torch.cat(n_iters).float(), torch.cat(residuals)
+        budgets = np.ceil(np.quantile(n_iters.numpy(), config.analysis.calibration_quantile, axis=0)).astype(int)
+        for block, budget in zip(reversed(blocks), budgets):
+            block.n_iters_budget.fill_(max(int(budget), 1))
+
+        logging.info("Iteration budgets per block (inversion order): {}".format(budgets.tolist()))
+        logging.info("Samples above the tolerance after {} iterations per block: {}".format(
+            config.model.n_iters, (residuals > config.analysis.calibration_tol).sum(dim=0).tolist()))
+
+        self.update_checkpoint(net, 'n_iters_budget')
+
+    def score(self):
+        # Per image bpd of --input (a uint8 N x H x W x C .npy file or a directory of images), written as a float32
+        # .npy file to --output (default: <input>.bpd.npy) in input order. Rerunning the task resumes an
+        # interrupted run. Images are dequantized to the centres of their bins, so the scores are reproducible and
+        # match the encode task.
+        dataset = self.get_input_dataset()
+        path = self.args.output or self.args.input.rstrip(os.sep) + '.bpd.npy'
+        writer = ResumableNpyWriter(path, (len(dataset),), np.float32)
+        if writer.n_done > 0:
+            logging.info("Resuming from {} / {} images".format(writer.n_done, len(dataset)))
+
+        net = self.load_net()
+        loader = DataLoader(Subset(dataset, range(writer.n_done, len(dataset))),
+                            batch_size=self.config.evaluation.batch_size, shuffle=False,
+                            num_workers=self.config.evaluation.num_workers, drop_last=False)
+        start_time = time.time()
+        n_scored = 0
+        with torch.no_grad():
+            for batch_idx, (data, _) in enumerate(loader):
+                data = self.preprocess(data, noise=False)
+                output, log_det = net(data)
+                writer.write(self.bits_per_dim(data, output, log_det).cpu().numpy())
+
+                n_scored += data.shape[0]
+                if (batch_idx + 1) % self.config.evaluation.log_interval == 0 or writer.done:
+                    logging.info("{} / {} images, {:.2f} images/sec".format(writer.n_done, len(dataset),
+                                                                            n_scored / (time.time() - start_time)))
+
+        logging.info("bpd written to {}".format(path))
+
+    def serve(self):
+        # Loads the model once and answers POST http://server.host:server.port/score requests (a .npy file of
+        # uint8 N x H x W x C images) with per image bpd, see runners/server.py. Concurrent requests are batched.
+        # Like the score task, images are dequantized to the centres of their bins.
+        net = self.load_net()
+
+        def score(images):
+            with torch.no_grad():
+                data = self.preprocess(torch.from_numpy(images).permute(0, 3, 1, 2).float() / 255., noise=False)
+                output, log_det = net(data)
+                return self.bits_per_dim(data, output, log_det).cpu().numpy()
+
+        image_shape = (self.config.data.image_size, self.config.data.image_size, self.config.data.channels)
+        batcher = DynamicBatcher(score, self.config.server.max_batch_size, self.config.server.max_latency_ms / 1000.)
+        logging.info("Serving on http://{}:{}/score".format(self.config.server.host, self.config.server.port))
+        serve(batcher, image_shape, self.config.server.host, self.config.server.port)
+
+    def load_test(self):
+        # Load test of a running serve task with the images of --input (a uint8 .npy file) or random images
+        image_shape = (self.config.data.image_size, self.config.data.image_size, self.config.data.channels)
+        if self.args.input is not None:
+            images = np.load(self.args.input, mmap_mode='r')
+            images = np.ascontiguousarray(images[:1024]).reshape(-1, *image_shape)
+        else:
+            images = np.random.randint(0, 256, size=(1024,) + image_shape, dtype=np.uint8)
+
+        url = 'http://{}:{}/score'.format(self.config.server.host, self.config.server.port)
+        n_requests = self.config.server.load_test_requests
+        images_per_request = self.config.server.load_test_images_per_request
+        latencies, wall_time = load_test(url, images, n_requests, self.config.server.load_test_concurrency,
+                                         images_per_request)
+        latencies = latencies * 1000.
+        logging.info("{} requests of {} images from {} threads in {:.2f}s: {:.1f} requests/sec, {:.1f} images/sec"
+                     .format(n_requests, images_per_request, self.config.server.load_test_concurrency, wall_time,
+                             n_requests / wall_time, n_requests * images_per_request / wall_time))
+        logging.info("Latency (ms): mean {:.1f}, p50 {:.1f}, p90 {:.1f}, p95 {:.1f}, p99 {:.1f}, max {:.1f}".format(
+            latencies.mean(), *np.percentile(latencies, [50, 90, 95, 99]), latencies.max()))
+
+    def get_latent_store(self, net):
+        # Dataset of the encode / decode tasks (--input, or the test set) and its LatentStore under --output
+        # (default: <run>/latents/<doc>). The store is keyed by a hash of the weights of net, so rewriting the
+        # checkpoint's buffers (calibrate, skip_analysis) keeps it, and records which dataset it holds.
+        if self.args.input is not None:
+            dataset = self.get_input_dataset()
+            identity = os.path.realpath(self.args.input)
+        else:
+            dataset = self.get_test_dataset()
+            identity = '{} test set'.format(self.config.data.dataset)
+
+        root = self.args.output or os.path.join(self.args.run, 'latents', self.args.doc)
+        weights_hash = arrays_hash({name: param.detach().cpu().numpy() for name, param in net.named_parameters()})
+        latent_dim = self.config.data.channels * self.config.data.image_size * self.config.data.image_size
+        return dataset, LatentStore(root, weights_hash, latent_dim, identity)
+
+    def encode(self):
+        # Writes the latents and log-dets of the dataset into its LatentStore, latent_store.chunk_size images per
+        # chunk. Only the dataset indices that are not stored yet are encoded, so rerunning the task resumes an
+        # interrupted run or adds the new images of a grown dataset. Images are dequantized to the centres of
+        # their bins, which makes the latents reproducible.
+        net = self.load_net()
+        dataset, store = self.get_latent_store(net)
+        missing = store.missing(len(dataset))
+        logging.info("{} of {} images in {}, encoding {}".format(len(store), len(dataset), store.directory,
+                                                                len(missing)))
+        loader = DataLoader(Subset(dataset, missing), batch_size=self.config.evaluation.batch_size, shuffle=False,
+                            num_workers=self.config.evaluation.num_workers, drop_last=False)
+        chunk_size = self.config.latent_store.chunk_size
+        latents, log_dets = [], []
+        n_encoded = 0
+        start_time = time.time()
+        with torch.no_grad():
+            for batch_idx, (data, _) in enumerate(loader):
+                output, log_det = net(self.preprocess(data, noise=False))
+                latents.append(output.cpu().numpy())
+                log_dets.append(log_det.cpu().numpy())
+                n_encoded += data.shape[0]
+
+                if sum(map(len, latents)) >= chunk_size or n_encoded == len(missing):
+                    latents, log_dets = np.concatenate(latents), np.concatenate(log_dets)
+                    start = n_encoded - len(latents)
+                    store.append(missing[start:n_encoded], latents, log_dets)
+                    latents, log_dets = [], []
+                    logging.info("{} / {} images, {:.2f} images/sec".format(n_encoded, len(missing),
+                                                                            n_encoded / (time.time() - start_time)))
+
+    def decode_latents(self, net, store, indices):
+        # images in [0, 1] of stored dataset indices, inverted with Net.sampling
+        latents, _ = store.get(indices)
+        return self.sigmoid_transform(net.sampling(torch.from_numpy(latents).to(self.config.device)))
+
+    def decode(self):
+        # Decodes the first latent_store.n_decode stored images, reports the reconstruction error against the
+        # dataset and saves them as a grid next to the store
+        net = self.load_net()
+        dataset, store = self.get_latent_store(net)
+        indices = np.arange(len(dataset))[store.contains(np.arange(len(dataset)))][:self.config.latent_store.n_decode]
+        images = self.decode_latents(net, store, indices)
+
+        originals = torch.stack([dataset[i][0] for i in indices]).to(images.device)
+        # the latents encode the centres of the quantization bins
+        error = (images - (originals * 255. + 0.5) / 256.).abs().reshape(len(indices), -1).max(dim=1)[0]
+        logging.info("Max reconstruction error: {:.2e} (mean over images {:.2e})".format(error.max().item(),
+                                                                                        error.mean().item()))
+        path = os.path.join(store.directory, 'decoded.png')
+        save_image(make_grid(images, int(np.ceil(np.sqrt(len(indices))))), path)
+        logging.info("Decoded images saved to {}".format(path))
+
+    def estimate_bpd(self, net, dataset):
+        # Anytime bpd estimate: streams randomly ordered batches of `dataset` and stops as soon as the
+        # evaluation.confidence confidence interval of the mean per-sample bpd is narrower than
+        # evaluation.ci_width (after at least evaluation.min_samples samples), or the dataset is exhausted.
+        # Returns the running statistics of the per-sample bpd.
+        loader = DataLoader(dataset, batch_size=self.config.evaluation.batch_size, shuffle=True,
+                            num_workers=self.config.evaluation.num_workers, drop_last=False)
+        stats = RunningStats()
+        with torch.no_grad():
+            for data, _ in loader:
+                data = self.preprocess(data)
+                output, log_det = net(data)
+                stats.update(self.bits_per_dim(data, output, log_det).cpu().numpy())
+                if stats.n >= self.config.evaluation.min_samples and \
+                        stats.ci_width(self.config.evaluation.confidence) < self.config.evaluation.ci_width:
+                    break
+        return stats
+
+    def anytime_bpd(self):
+        # Test set bpd of --checkpoint of this run, to the precision evaluation.ci_width (see estimate_bpd)
+        dataset = self.get_test_dataset()
+        net = self.load_net()
+        start_time = time.time()
+        stats = self.estimate_bpd(net, dataset)
+        width = stats.ci_width(self.config.evaluation.confidence)
+        logging.info("bpd: {:.5f} +- {:.5f} ({:.0%} confidence) from {} of {} test images, {:.2f}s{}".format(
+            stats.mean, width / 2, self.config.evaluation.confidence, stats.n, len(dataset),
+            time.time() - start_time,
+            '' if width < self.config.evaluation.ci_width else ', test set exhausted before reaching ci_width'))
+
+    def multi_sample_bpd(self):
+        # Test set bpd with evaluation.n_draws dequantization noise draws per image: the average of the K single
+        # draw bpd and the tighter importance-weighted bound -log2(1/K sum_k p(x + u_k)) / D. Every batch of
+        # evaluation.batch_size // K images is loaded once and replicated K times along the batch dimension, so
+        # that each forward pass runs evaluation.batch_size samples.
+        n_draws = self.config.evaluation.n_draws
+        batch_size = max(1, self.config.evaluation.batch_size // n_draws)
+        test_loader = DataLoader(self.get_test_dataset(), batch_size=batch_size, shuffle=False,
+                                 num_workers=self.config.evaluation.num_workers, drop_last=False)
+        net = self.load_net()
+        n_dims = self.config.data.channels * self.config.data.image_size * self.config.data.image_size
+
+        total_bpd, total_iw_bpd = 0., 0.
+        n_data = 0
+        start_time = time.time()
+        with torch.no_grad():
+            for batch_idx, (test_data, _) in enumerate(tqdm.tqdm(test_loader)):
+                data = self.preprocess(test_data.to(self.config.device).repeat_interleave(n_draws, dim=0))
+                output, log_det = net(data)
+                # shape: B x n_draws
+                bpd = self.bits_per_dim(data, output, log_det).view(-1, n_draws).double()
+                log_likelihood = -(bpd - 8) * n_dims * np.log(2)
+                iw_bpd = -(torch.logsumexp(log_likelihood, dim=1) - np.log(n_draws)) / (n_dims * np.log(2)) + 8
+
+                total_bpd += bpd.mean(dim=1).sum().item()
+                total_iw_bpd += iw_bpd.sum().item()
+                n_data += test_data.shape[0]
+
+        logging.info("{} images, {} draws each, {:.2f} images/sec".format(n_data, n_draws,
+                                                                         n_data / (time.time() - start_time)))
+        logging.info("Average bpd: {:.5f}, importance-weighted bpd: {:.5f}".format(total_bpd / n_data,
+                                                                                    total_iw_bpd / n_data))
+
+    def skip_analysis(self):
+        # Measures how far every block is from its scale-only equivalent t * x on test images, stores the
+        # deviations in the checkpoint (see BasicBlock.scale_only) and reports the bpd drift and speed of
+        # skipping the blocks below a few tolerances, analysis.skip_tol included
+        config = copy.deepcopy(self.config)
+        config.analysis.skip_tol = 0.
+        net = self.load_net(config)
+        blocks = [module for module in net.modules() if isinstance(module, BasicBlock)]
+
+        test_loader = DataLoader(self.get_test_dataset(), batch_size=self.config.training.batch_size, shuffle=True,
+                                 num_workers=4, drop_last=False)
+        batches, deviations = [], []
+        n_data = 0
+        with torch.no_grad():
+            for test_data, _ in test_loader:
+                # the same dequantized batches are reused for every tolerance below
+                x = self.preprocess(test_data)
+                batches.append(x)
+                x = x.contiguous(memory_format=torch.channels_last) if config.model.channels_last else x
+                batch_deviations = []
+                for layer in net.module.layers:
+                    if isinstance(layer, SpaceToDepth):
+                        x, _ = layer([x, None])
+                        continue
+                    for block in layer:
+                        x, deviation = block.scale_deviation(x)
+                        batch_deviations.append(deviation.max())
+                deviations.append(torch.stack(batch_deviations))
+                n_data += test_data.shape[0]
+                if n_data >= config.analysis.skip_samples:
+                    break
+
+        deviations = torch.stack(deviations).max(dim=0)[0]
+        for block, deviation in zip(blocks, deviations):
+            block.set_deviation(deviation.item())
+        logging.info("Deviation from t * x per block: {}".format(['{:.2e}'.format(d) for d in deviations.tolist()]))
+        self.update_checkpoint(net, 'deviation')
+
+        def evaluate():
+            bpd = []
+            start_time = time.time()
+            with torch.no_grad():
+                for x in batches:
+                    output, log_det = net(x)
+                    bpd.append(self.bits_per_dim(x, output, log_det))
+            if self.config.device.type == 'cuda':
+                torch.cuda.synchronize()
+            return torch.cat(bpd).mean().item(), time.time() - start_time
+
+        evaluate()
+        full_bpd, full_time = evaluate()
+        logging.info("All blocks: bpd {:.5f}, {:.3f}s".format(full_bpd, full_time))
+        for tol in sorted({1e-4, 1e-3, 1e-2, 1e-1, self.config.analysis.skip_tol} - {0.}):
+            config.analysis.skip_tol = tol
+            bpd, time_taken = evaluate()
+            logging.info("skip_tol {:.0e}: {} / {} blocks skipped, bpd {:.5f} (drift {:+.2e}), {:.3f}s".format(
+                tol, sum(block.scale_only for block in blocks), len(blocks), bpd, bpd - full_bpd, time_taken))
+
+    def benchmark(self):
+        # Times the masked convolution backends (model.conv_bands) against the dense path on random inputs
+        n_repeats = 10
+        data = torch.randn(self.config.training.batch_size, self.config.data.channels, self.config.data.image_size,
+                           self.config.data.image_size, device=self.config.device)
+
+        def timed(fn):
+            fn()
+            if self.config.device.type == 'cuda':
+                torch.cuda.synchronize()
+            start_time = time.time()
+            for _ in range(n_repeats):
+                fn()
+            if self.config.device.type == 'cuda':
+                torch.cuda.synchronize()
+            return (time.time() - start_time) / n_repeats
+
+        dense_net = None
+        for n_bands in sorted({1, 2, 3, 4, self.config.model.conv_bands}):
+            config = copy.deepcopy(self.config)
+            config.model.conv_bands = n_bands
+            net = Net(config).to(self.config.device)
+            if dense_net is None:
+                dense_net = net
+            else:
+                net.load_state_dict(dense_net.state_dict())
+
+            def train_step():
+                net.zero_grad()
+                output, log_det = net(data)
+                loss = 0.5 * output.pow(2).sum() - log_det.sum()
+                loss.backward()
+
+            def eval_step():
+                with torch.no_grad():
+                    net(data)
+
+            with torch.no_grad():
+                dense_output, dense_log_det = dense_net(data)
+                output, log_det = net(data)
+
+            logging.info("conv_bands: {}, train step: {:.4f}s, eval forward: {:.4f}s, max output diff: {:.2e}, "
+                         "max log_det diff: {:.2e}".format(n_bands, timed(train_step), timed(eval_step),
+                                                          (output - dense_output).abs().max().item(),
+                                                          (log_det - dense_log_det).abs().max().item()))
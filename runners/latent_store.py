@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def arrays_hash(arrays, length=16):
+    # Hex sha1 prefix of a dict of named arrays (names, dtypes, shapes and values), independent of the dict order
+    sha1 = hashlib.sha1()
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        sha1.update('{}:{}:{}'.format(name, array.dtype.str, array.shape).encode())
+        sha1.update(array.tobytes())
+    return sha1.hexdigest()[:length]
+
+
+class LatentStore(object):
+    # Latents (N x latent_dim float32) and log-dets (N float32) of a dataset as encoded by one checkpoint, kept
+    # in <root>/<checkpoint_hash>/ so that stores of different checkpoints never mix. `dataset` identifies the
+    # encoded dataset, opening the store with another one raises since rows are keyed by index. The rows live in
+    # append-only chunks of .npy files that are memory-mapped on read:
+    #   chunk_<k>_indices.npy, chunk_<k>_latents.npy, chunk_<k>_log_dets.npy
+    # and index.json lists the complete chunks. A chunk is only added to index.json once its files are written,
+    # so an interrupted encode loses at most the chunk in progress. Rows are looked up by dataset index.
+    def __init__(self, root, checkpoint_hash, latent_dim, dataset):
+        self.directory = os.path.join(root, checkpoint_hash)
+        self.index_path = os.path.join(self.directory, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+            if self.index['latent_dim'] != latent_dim:
+                raise ValueError('{} holds latents of dimension {}, expected {}'.format(
+                    self.directory, self.index['latent_dim'], latent_dim))
+            if self.index.get('dataset') != dataset:
+                raise ValueError('{} holds latents of {}, not of {}'.format(
+                    self.directory, self.index.get('dataset'), dataset))
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            self.index = {'checkpoint': checkpoint_hash, 'dataset': dataset, 'latent_dim': latent_dim, 'chunks': []}
+            self._save_index()
+
+        self.chunks = [self._load_chunk(chunk['name']) for chunk in self.index['chunks']]
+        self._build_lookup()
+
+    def _path(self, name, array):
+        return os.path.join(self.directory, '{}_{}.npy'.format(name, array))
+
+    def _load_chunk(self, name):
+        return {array: np.load(self._path(name, array), mmap_mode='r') for array in ('indices', 'latents', 'log_dets')}
+
+    def _save_index(self):
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def _build_lookup(self):
+        # chunk and row of every stored dataset index, -1 where missing
+        size = max([int(chunk['indices'].max()) + 1 for chunk in self.chunks if len(chunk['indices'])] + [0])
+        self.chunk_of = np.full(size, -1, dtype=np.int64)
+        self.row_of = np.full(size, -1, dtype=np.int64)
+        for k, chunk in enumerate(self.chunks):
+            self.chunk_of[chunk['indices']] = k
+            self.row_of[chunk['indices']] = np.arange(len(chunk['indices']))
+
+    def __len__(self):
+        return int((self.chunk_of >= 0).sum())
+
+    def contains(self, indices):
+        indices = np.asarray(indices)
+        stored = np.zeros(indices.shape, dtype=bool)
+        in_range = indices < len(self.chunk_of)
+        stored[in_range] = self.chunk_of[indices[in_range]] >= 0
+        return stored
+
+    def missing(self, n):
+        # dataset indices in range(n) that are not stored yet
+        indices = np.arange(n)
+        return indices[~self.contains(indices)]
+
+    def append(self, indices, latents, log_dets):
+        name = 'chunk_{:05d}'.format(len(self.index['chunks']))
+        arrays = {'indices': np.asarray(indices, dtype=np.int64),
+                  'latents': np.asarray(latents, dtype=np.float32).reshape(len(indices), self.index['latent_dim']),
+                  'log_dets': np.asarray(log_dets, dtype=np.float32)}
+        for array, value in arrays.items():
+            path = self._path(name, array)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, value)
+            os.replace(path + '.tmp', path)
+
+        self.index['chunks'].append({'name': name, 'size': len(indices)})
+        self._save_index()
+        self.chunks.append(self._load_chunk(name))
+        self._build_lookup()
+
+    def get(self, indices):
+        # latents and log-dets of the given dataset indices, in that order
+        indices = np.asarray(indices)
+        if not self.contains(indices).all():
+            raise KeyError('dataset indices {} are not stored'.format(indices[~self.contains(indices)].tolist()))
+        latents = np.empty((len(indices), self.index['latent_dim']), dtype=np.float32)
+        log_dets = np.empty(len(indices), dtype=np.float32)
+        chunk_of, row_of = self.chunk_of[indices], self.row_of[indices]
+        for k in np.unique(chunk_of):
+            selected = chunk_of == k
+            latents[selected] = self.chunks[k]['latents'][row_of[selected]]
+            log_dets[selected] = self.chunks[k]['log_dets'][row_of[selected]]
+        return latents, log_dets
@@ -0,0 +1,167 @@
+import io
+import json
+import queue
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+
+class _Request(object):
+    def __init__(self, images):
+        self.images = images
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DynamicBatcher(object):
+    # Coalesces concurrent calls into batches of at most max_batch_size images for `score`, which maps a
+    # uint8 N x H x W x C array to N values. A batch runs as soon as it is full or its oldest request has
+    # waited max_latency seconds. A request larger than max_batch_size runs as a batch of its own.
+    def __init__(self, score, max_batch_size, max_latency):
+        self.score = score
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, images):
+        request = _Request(images)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self):
+        pending = None
+        while True:
+            requests = [pending or self.queue.get()]
+            pending = None
+            n_images = len(requests[0].images)
+            deadline = requests[0].arrival + self.max_latency
+            while n_images < self.max_batch_size:
+                # past the deadline only the requests that are already waiting join the batch
+                timeout = deadline - time.time()
+                try:
+                    request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if n_images + len(request.images) > self.max_batch_size:
+                    # starts the next batch
+                    pending = request
+                    break
+                requests.append(request)
+                n_images += len(request.images)
+
+            try:
+                results = self.score(np.concatenate([request.images for request in requests]))
+                splits = np.cumsum([len(request.images) for request in requests])[:-1]
+                for request, result in zip(requests, np.split(results, splits)):
+                    request.result = result
+            except Exception as e:
+                for request in requests:
+                    request.error = e
+            for request in requests:
+                request.done.set()
+
+
+def make_handler(batcher, image_shape):
+    # POST /score with a .npy file of uint8 images (N x H x W x C, or a single H x W x C image) as the body
+    # answers {"bpd": [...]}, GET /health answers {"status": "ok"}
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, content):
+            body = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._reply(200, {'status': 'ok'})
+            else:
+                self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+                return
+
+            try:
+                images = np.load(io.BytesIO(self.rfile.read(int(self.headers['Content-Length']))),
+                                 allow_pickle=False)
+            except (ValueError, TypeError, OSError) as e:
+                self._reply(400, {'error': 'body is not a .npy file: {}'.format(e)})
+                return
+            if images.ndim == len(image_shape):
+                images = images[None]
+            if images.dtype != np.uint8 or tuple(images.shape[1:]) != tuple(image_shape):
+                self._reply(400, {'error': 'expected uint8 images of shape {}, got {} {}'.format(
+                    tuple(image_shape), images.dtype, images.shape)})
+                return
+
+            try:
+                self._reply(200, {'bpd': batcher(images).tolist()})
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(batcher, image_shape, host, port):
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, image_shape))
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def encode_images(images):
+    buffer = io.BytesIO()
+    np.save(buffer, images, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def load_test(url, images, n_requests, concurrency, images_per_request):
+    # Sends n_requests POST requests of images_per_request consecutive images of `images` from `concurrency`
+    # threads. Returns the latency of every request (in seconds) and the wall time of the whole run.
+    payloads = [encode_images(images[(i * images_per_request + np.arange(images_per_request)) % len(images)])
+                for i in range(n_requests)]
+    latencies = [None] * n_requests
+    errors = []
+
+    def worker(indices):
+        for i in indices:
+            request = urllib.request.Request(url, data=payloads[i],
+                                             headers={'Content-Type': 'application/octet-stream'})
+            start_time = time.time()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+            except Exception as e:
+                errors.append(e)
+                continue
+            latencies[i] = time.time() - start_time
+
+    threads = [threading.Thread(target=worker, args=(range(i, n_requests, concurrency),))
+               for i in range(concurrency)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.time() - start_time
+
+    if errors:
+        raise RuntimeError('{} / {} requests failed, first error: {}'.format(len(errors), n_requests, errors[0]))
+    return np.array(latencies), wall_time
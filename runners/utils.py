@@ -0,0 +1,81 @@
+import os
+import numpy as np
+import torch
+from statistics import NormalDist
+
+
+class ResumableNpyWriter(object):
+    # Fills a pre-allocated .npy file (np.lib.format.open_memmap) front to back. The number of rows written so
+    # far is kept in <path>.progress and only updated once the rows are flushed, so that an interrupted run can
+    # continue from the last completed write.
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.progress_path = path + '.progress'
+        shape, dtype = tuple(shape), np.dtype(dtype)
+
+        if os.path.exists(path) and os.path.exists(self.progress_path):
+            self.array = np.load(path, mmap_mode='r+')
+            if self.array.shape != shape or self.array.dtype != dtype:
+                raise ValueError('{} holds a {} {} array, expected {} {}'.format(path, self.array.shape,
+                                                                                 self.array.dtype, shape, dtype))
+            with open(self.progress_path) as f:
+                self.n_done = int(f.read())
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+            self.n_done = 0
+            self._save_progress()
+
+    @property
+    def done(self):
+        return self.n_done >= self.array.shape[0]
+
+    def write(self, rows):
+        end = self.n_done + rows.shape[0]
+        self.array[self.n_done:end] = rows
+        self.array.flush()
+        self.n_done = end
+        self._save_progress()
+
+    def _save_progress(self):
+        with open(self.progress_path + '.tmp', 'w') as f:
+            f.write(str(self.n_done))
+        os.replace(self.progress_path + '.tmp', self.progress_path)
+
+
+def to_uint8(images):
+    # B x C x H x W images in [0, 1] -> B x H x W x C uint8 array, rounded like torchvision.utils.save_image
+    images = images.mul(255).add_(0.5).clamp_(0, 255).to(dtype=torch.uint8)
+    return images.permute(0, 2, 3, 1).cpu().numpy()
+
+
+class RunningStats(object):
+    # Running mean and variance of a stream of values, updated batch-wise (Welford's algorithm with the pairwise
+    # merge of Chan et al.), in float64
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if len(values) == 0:
+            return
+        n, mean = len(values), values.mean()
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean += delta * n / total
+        self.m2 += ((values - mean) ** 2).sum() + delta ** 2 * self.n * n / total
+        self.n = total
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else float('inf')
+
+    def ci_width(self, confidence=0.95):
+        # width of the normal confidence interval of the mean
+        if self.n < 2:
+            return float('inf')
+        return 2 * NormalDist().inv_cdf(0.5 + confidence / 2) * np.sqrt(self.variance / self.n)